@@ -14,6 +14,7 @@ from ...models.image import Image
 from ...models.faiss_index import FaissIndexInfo
 from ...models.operation_log import OperationLog
 from ...services.faiss_service import FaissService
+from ...services.model_service import ModelService
 from ...utils.logger import api_logger
 
 router = APIRouter()
@@ -27,6 +28,19 @@ def get_faiss_service(request: Request) -> FaissService:
     return request.app.state.faiss_service
 
 
+def get_model_service(request: Request) -> ModelService:
+    """获取模型服务"""
+    if not hasattr(request.app.state, 'model_service'):
+        raise HTTPException(status_code=500, detail="模型服务未初始化")
+    return request.app.state.model_service
+
+
+class ProfileRequest(BaseModel):
+    """逐层剖析开关"""
+    enabled: bool = True
+    track_memory: bool = True
+
+
 @router.get("/dashboard")
 async def get_dashboard_stats(
     db: Session = Depends(get_db),
@@ -206,6 +220,50 @@ async def clear_system_cache():
         raise HTTPException(status_code=500, detail=f"清理缓存失败: {str(e)}")
 
 
+@router.get("/model/profile")
+async def get_model_profile(
+    reset: bool = False,
+    model_service: ModelService = Depends(get_model_service)
+):
+    """获取模型逐层剖析报告（各子算子耗时、占比、GFLOP/s、分配字节数）"""
+    try:
+        report = model_service.get_profile_report(reset=reset)
+        if report is None:
+            return {
+                "success": False,
+                "message": "逐层剖析未开启"
+            }
+        
+        return {
+            "success": True,
+            "data": report
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取剖析报告失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取剖析报告失败: {str(e)}")
+
+
+@router.post("/model/profile")
+async def set_model_profile(
+    profile_request: ProfileRequest,
+    model_service: ModelService = Depends(get_model_service)
+):
+    """开启/关闭模型逐层剖析"""
+    try:
+        model_service.enable_profiling(profile_request.enabled, profile_request.track_memory)
+        api_logger.info(f"模型逐层剖析: {'开启' if profile_request.enabled else '关闭'}")
+        
+        return {
+            "success": True,
+            "message": f"逐层剖析已{'开启' if profile_request.enabled else '关闭'}"
+        }
+        
+    except Exception as e:
+        api_logger.error(f"设置逐层剖析失败: {e}")
+        raise HTTPException(status_code=500, detail=f"设置逐层剖析失败: {str(e)}")
+
+
 @router.post("/index/rebuild")
 async def rebuild_faiss_index(
     faiss_service: FaissService = Depends(get_faiss_service)
@@ -57,9 +57,26 @@ class ModelConfig(BaseModel):
     pretrained: bool = True
     device: str = "cuda"
     batch_size: int = 32
+    preprocess_workers: int = 2  # 批量提取时解码/预处理的线程数，与推理流水线重叠
     weights_path: str = "data\\models\\dinov2_vits14_pretrain.npz"
     target_size: int = 224
     patch_size: int = 14
+    resize: str = "pil"  # 预处理 resize 实现：pil / cv2 / auto（cv2 更快，但像素与构建图库时的 Pillow 略有差异）
+    dtype: str = "float32"  # 推理计算精度（预处理与前向）
+    weight_dtype: Optional[str] = None  # Linear 权重存储精度，如 "float16"（前向按 dtype 累加；只省内存，吞吐低于 float32 存储）
+    quantization: Optional[str] = None  # "int8": Linear 使用 per-channel int8 权重（存于 .int8.npz）
+    attention: str = "auto"  # full / tiled / auto（token 数超过 attention_tile_threshold 时分块）
+    attention_block_size: int = 256
+    attention_tile_threshold: int = 1024
+    workspace_max_mb: Optional[float] = None  # 每个推理线程复用的激活缓冲区上限（MB），None 不设上限，0 表示关闭
+    backend: str = "numpy"  # 推理后端：numpy / torch / onnxruntime（device 为 cuda 时 torch / onnxruntime 尝试使用 GPU）
+    num_threads: Optional[int] = None  # 推理引擎线程数，None 使用引擎默认值
+    validate_backend: bool = True  # 加载时用 demo_data/cat_dog_feature.npy 校验非 numpy 后端，不通过则回退到 numpy
+    fused_kernels: bool = False  # GELU / softmax / LayerNorm 使用分块融合实现（numexpr 可选），线程数取 num_threads
+    token_merge_r: int = 0  # token merging（ToMe）每层合并的 token 数，0 表示关闭
+    profile: bool = False  # 启动时开启逐层剖析（也可通过 /admin/model/profile 切换）
+    micro_batch_window_ms: float = 8.0  # 单张特征提取的动态微批收集窗口（毫秒），0 表示关闭
+    micro_batch_max_size: int = 8  # 同一分辨率凑满这么多请求时立即前向，不等窗口结束
 
 
 class AuthConfig(BaseModel):
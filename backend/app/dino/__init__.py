@@ -1,31 +1,69 @@
 """DINOv2模型模块"""
 
 from .dinov2_numpy import (
+    common_patch_grids,
+    infer_config,
+    parse_output_spec,
     gelu,
     softmax,
+    FusedKernels,
+    bipartite_soft_matching,
     Embeddings,
     LayerNorm,
     LayerScale,
     Linear,
+    QuantizedLinear,
     MultiHeadAttention,
     TransformerBlock,
-    VisionTransformer
+    Dinov2Numpy,
+    Profiler,
+    Workspace,
+    WorkspaceCache,
+    quantize_weights,
+    load_int8_weights,
+    load_weights,
+    load_mmap_weights,
+    save_mmap_weights
 )
 from .preprocess_image import (
+    normalization_lut,
+    normalize_to_chw,
+    short_side_size,
+    open_image,
+    load_image,
     center_crop,
     resize_short_side
 )
 
 __all__ = [
+    'common_patch_grids',
+    'infer_config',
+    'parse_output_spec',
     'gelu',
     'softmax',
+    'FusedKernels',
+    'bipartite_soft_matching',
     'Embeddings',
     'LayerNorm',
     'LayerScale',
     'Linear',
+    'QuantizedLinear',
     'MultiHeadAttention',
     'TransformerBlock',
-    'VisionTransformer',
+    'Dinov2Numpy',
+    'Profiler',
+    'Workspace',
+    'WorkspaceCache',
+    'quantize_weights',
+    'load_int8_weights',
+    'load_weights',
+    'load_mmap_weights',
+    'save_mmap_weights',
+    'normalization_lut',
+    'normalize_to_chw',
+    'short_side_size',
+    'open_image',
+    'load_image',
     'center_crop',
     'resize_short_side'
 ]
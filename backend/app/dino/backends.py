@@ -0,0 +1,210 @@
+"""
+推理后端
+
+同一份 .npz 权重可以用不同引擎推理，由配置 model.backend 选择：
+  - numpy: Dinov2Numpy 参考实现（padded batch、token merging、int8 等全部特性）
+  - torch: PyTorch 实现（dinov2_torch.TorchDinov2），torch.set_num_threads 控制线程数
+  - onnxruntime: 从同一份权重导出的 ONNX 模型（缓存在权重文件旁），ONNX Runtime CPU 推理
+
+所有后端接受 (B, C, H, W) 数组或不同分辨率图像的 list，返回 (B, D) 的 CLS 特征，
+并可用 validate_backend() 与 demo_data/cat_dog_feature.npy 对比，确认切换引擎后结果一致。
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from .dinov2_numpy import Dinov2Numpy
+
+
+def onnx_model_path(path):
+    """weights.npz -> weights.onnx（导出的 ONNX 模型）"""
+    return os.path.splitext(path)[0] + ".onnx"
+
+
+class InferenceBackend:
+    """
+    推理后端基类。
+
+    model: 参考实现 Dinov2Numpy（提供准备好的权重与带缓存的位置编码插值）
+    batch_size: 单次前向的最大图像数
+    num_threads: 引擎内部线程数，None 表示使用引擎默认值
+    """
+
+    name = None
+
+    def __init__(self, model, batch_size=32, num_threads=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.feature_dim = model.config["hidden_size"]
+        self.patch_size = model.config["patch_size"]
+
+    def forward(self, pixel_values):
+        """(B, C, H, W) float32 -> (B, D)，由子类实现"""
+        raise NotImplementedError
+
+    def __call__(self, pixel_values):
+        if not isinstance(pixel_values, (list, tuple)):
+            pixel_values = np.asarray(pixel_values, dtype=np.float32)
+            return np.concatenate([
+                self.forward(pixel_values[i:i + self.batch_size])
+                for i in range(0, pixel_values.shape[0], self.batch_size)
+            ], axis=0)
+
+        # 不同分辨率的图像按形状分组，每组堆叠后前向，结果按输入顺序返回
+        pixel_values = [p if p.ndim == 4 else p[None] for p in pixel_values]
+        groups = {}
+        for i, p in enumerate(pixel_values):
+            groups.setdefault(p.shape[1:], []).append(i)
+        features = np.empty((len(pixel_values), self.feature_dim), dtype=np.float32)
+        for indices in groups.values():
+            batch = np.concatenate([pixel_values[i] for i in indices], axis=0)
+            features[indices] = self(batch)
+        return features
+
+    def pos_embed(self, pixel_values):
+        _, _, H, W = pixel_values.shape
+        return np.asarray(self.model.embeddings.interpolate_pos_encoding(None, H, W), dtype=np.float32)
+
+
+class NumpyBackend(InferenceBackend):
+    name = "numpy"
+
+    def __call__(self, pixel_values):
+        # list 输入由 Dinov2Numpy 以 padded batch 模式一次前向
+        if isinstance(pixel_values, (list, tuple)):
+            return np.concatenate([
+                self.model(list(pixel_values[i:i + self.batch_size]))
+                for i in range(0, len(pixel_values), self.batch_size)
+            ], axis=0)
+        return super().__call__(pixel_values)
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values)
+
+
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    def __init__(self, model, batch_size=32, num_threads=None, device="cpu"):
+        super().__init__(model, batch_size, num_threads)
+        import torch
+        from .dinov2_torch import TorchDinov2
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if device != "cpu" and not torch.cuda.is_available():
+            device = "cpu"
+        self.torch = torch
+        self.device = torch.device(device)
+        self.module = TorchDinov2(model).eval().to(self.device)
+
+    def forward(self, pixel_values):
+        torch = self.torch
+        with torch.inference_mode():
+            out = self.module(
+                torch.from_numpy(np.ascontiguousarray(pixel_values, dtype=np.float32)).to(self.device),
+                torch.from_numpy(self.pos_embed(pixel_values)).to(self.device),
+            )
+        return out.cpu().numpy()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = "onnxruntime"
+
+    _export_lock = threading.Lock()
+
+    def __init__(self, model, weights_path, batch_size=32, num_threads=None, device="cpu"):
+        super().__init__(model, batch_size, num_threads)
+        import onnxruntime as ort
+
+        # 首次使用（或权重更新后）从同一份权重导出 ONNX 模型，需要 torch
+        self.onnx_path = onnx_model_path(weights_path)
+        with self._export_lock:
+            if not os.path.exists(self.onnx_path) or (
+                os.path.exists(weights_path) and os.path.getmtime(weights_path) > os.path.getmtime(self.onnx_path)
+            ):
+                from .dinov2_torch import export_onnx
+                export_onnx(model, self.onnx_path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        if device == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(self.onnx_path, options, providers=providers)
+
+    def forward(self, pixel_values):
+        return self.session.run(["cls"], {
+            "pixel_values": np.ascontiguousarray(pixel_values, dtype=np.float32),
+            "pos_embed": self.pos_embed(pixel_values),
+        })[0]
+
+
+BACKENDS = {
+    NumpyBackend.name: NumpyBackend,
+    TorchBackend.name: TorchBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+}
+
+
+def create_backend(name, model, weights_path=None, batch_size=32, num_threads=None, device="cpu"):
+    """按名字创建推理后端；torch / onnxruntime 在首次使用时才导入"""
+    if name not in BACKENDS:
+        raise ValueError(f"不支持的推理后端: {name}，可选: {list(BACKENDS)}")
+    if name == NumpyBackend.name:
+        return NumpyBackend(model, batch_size, num_threads)
+    if name == TorchBackend.name:
+        return TorchBackend(model, batch_size, num_threads, device)
+    return OnnxRuntimeBackend(model, weights_path, batch_size, num_threads, device)
+
+
+def validate_backend(backend, demo_dir="demo_data", tol=1e-3):
+    """
+    用 demo_data 中的 cat / dog 图像（center_crop）与参考特征 cat_dog_feature.npy 对比。
+    返回 {"max_abs_diff", "min_cosine", "passed"}；参考特征维度与模型不一致（如 ViT-S 权重）时返回 None。
+    """
+    from .preprocess_image import center_crop
+
+    ref = np.load(os.path.join(demo_dir, "cat_dog_feature.npy"))
+    if ref.shape[-1] != backend.feature_dim:
+        return None
+    pixel_values = np.concatenate([
+        center_crop(os.path.join(demo_dir, f"{name}.jpg")) for name in ["cat", "dog"]
+    ], axis=0)
+    feats = backend(pixel_values)
+    max_abs = float(np.max(np.abs(feats - ref)))
+    cos = np.sum(feats * ref, axis=1) / (np.linalg.norm(feats, axis=1) * np.linalg.norm(ref, axis=1))
+    return {"max_abs_diff": max_abs, "min_cosine": float(cos.min()), "passed": max_abs < tol}
+
+
+if __name__ == "__main__":
+    # 在当前主机上逐个验证并测速各后端：python -m app.dino.backends <weights.npz> [demo_dir]
+    import sys
+    import time
+
+    from .dinov2_numpy import load_weights
+    from .preprocess_image import resize_short_side
+
+    weights_path = sys.argv[1]
+    demo_dir = sys.argv[2] if len(sys.argv) > 2 else "demo_data"
+    model = Dinov2Numpy(load_weights(weights_path))
+    pixel_values = [resize_short_side(os.path.join(demo_dir, f"{name}.jpg")) for name in ["cat", "dog"]]
+    for name in BACKENDS:
+        try:
+            backend = create_backend(name, model, weights_path)
+        except ImportError as e:
+            print(f"{name:<12} 不可用: {e}")
+            continue
+        result = validate_backend(backend, demo_dir)
+        backend(pixel_values)  # 预热
+        start = time.perf_counter()
+        backend(pixel_values)
+        elapsed = (time.perf_counter() - start) / len(pixel_values)
+        print(f"{name:<12} {elapsed * 1000:8.1f} ms/img  validation={result}")
@@ -0,0 +1,117 @@
+"""
+DINOv2 的 PyTorch 实现（CPU 推理 / ONNX 导出）
+
+直接复用 Dinov2Numpy 加载时准备好的权重（融合 QKV、折叠注意力缩放与 LayerScale），
+因此与 NumPy 参考实现的计算完全一致。位置编码插值仍由 NumPy 侧完成（带缓存），
+作为第二个输入传入，使 ONNX 图不依赖输入分辨率相关的插值算子。
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def dense_weight(linear):
+    """Linear / QuantizedLinear -> float32 的 (in_features, out_features) 权重与偏置"""
+    if hasattr(linear, "qweight"):
+        weight = linear.qweight.astype(np.float32) * linear.scale.astype(np.float32)
+    else:
+        weight = linear.weight.astype(np.float32)
+    return torch.from_numpy(np.ascontiguousarray(weight)), torch.from_numpy(linear.bias.astype(np.float32))
+
+
+def gelu(x):
+    # 与 dinov2_numpy.gelu 相同的 tanh 近似
+    return F.gelu(x, approximate="tanh")
+
+
+class TorchBlock(nn.Module):
+    def __init__(self, blk):
+        super().__init__()
+        self.num_heads = blk.attn.num_heads
+        self.eps = blk.norm1.eps
+        for name, norm in [("norm1", blk.norm1), ("norm2", blk.norm2)]:
+            self.register_buffer(f"{name}_weight", torch.from_numpy(norm.weight.astype(np.float32)))
+            self.register_buffer(f"{name}_bias", torch.from_numpy(norm.bias.astype(np.float32)))
+        for name, linear in [
+            ("qkv", blk.attn.qkv_proj), ("proj", blk.attn.out_proj), ("fc1", blk.mlp.fc1), ("fc2", blk.mlp.fc2)
+        ]:
+            weight, bias = dense_weight(linear)
+            self.register_buffer(f"{name}_weight", weight)
+            self.register_buffer(f"{name}_bias", bias)
+
+    def forward(self, x):
+        B, N, D = x.shape
+        H = self.num_heads
+
+        h = F.layer_norm(x, (D,), self.norm1_weight, self.norm1_bias, self.eps)
+        qkv = (h @ self.qkv_weight + self.qkv_bias).reshape(B, N, 3, H, D // H).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        att = torch.softmax(q @ k.transpose(-2, -1), dim=-1)  # 缩放已折叠进 q
+        ctx = (att @ v).transpose(1, 2).reshape(B, N, D)
+        x = x + (ctx @ self.proj_weight + self.proj_bias)
+
+        h = F.layer_norm(x, (D,), self.norm2_weight, self.norm2_bias, self.eps)
+        h = gelu(h @ self.fc1_weight + self.fc1_bias)
+        return x + (h @ self.fc2_weight + self.fc2_bias)
+
+
+class TorchDinov2(nn.Module):
+    """
+    由 Dinov2Numpy 构建的 PyTorch 模块。
+
+    forward(pixel_values, pos_embed):
+        pixel_values: (B, 3, H, W) float32
+        pos_embed: (1, 1 + h*w, D)，即 model.embeddings.interpolate_pos_encoding(None, H, W)
+        return: (B, D) CLS 特征
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        emb = model.embeddings
+        D, ps = emb.hidden_size, emb.patch_size
+        self.patch_size = ps
+        # (patch_dim, D) -> Conv2d 权重 (D, C, ps, ps)，patch 向量按 (C, ps, ps) 展开，与 pixel2patches 一致
+        self.register_buffer(
+            "patch_weight", torch.from_numpy(np.ascontiguousarray(emb.patch_embed_w.T, dtype=np.float32).reshape(D, -1, ps, ps))
+        )
+        self.register_buffer("patch_bias", torch.from_numpy(emb.patch_embed_b.reshape(-1).astype(np.float32)))
+        self.register_buffer("cls_token", torch.from_numpy(emb.cls_token.reshape(1, 1, D).astype(np.float32)))
+        self.blocks = nn.ModuleList([TorchBlock(blk) for blk in model.blocks])
+        self.eps = model.norm.eps
+        self.register_buffer("norm_weight", torch.from_numpy(model.norm.weight.astype(np.float32)))
+        self.register_buffer("norm_bias", torch.from_numpy(model.norm.bias.astype(np.float32)))
+
+    def forward(self, pixel_values, pos_embed):
+        B = pixel_values.shape[0]
+        x = F.conv2d(pixel_values, self.patch_weight, self.patch_bias, stride=self.patch_size)
+        x = x.flatten(2).transpose(1, 2)  # (B, h*w, D)
+        x = torch.cat([self.cls_token.expand(B, -1, -1), x], dim=1) + pos_embed
+        for blk in self.blocks:
+            x = blk(x)
+        x = F.layer_norm(x, (x.shape[-1],), self.norm_weight, self.norm_bias, self.eps)
+        return x[:, 0]
+
+
+def export_onnx(model, path, opset_version=17):
+    """把 Dinov2Numpy 导出为 ONNX（batch / 高 / 宽均为动态维度）"""
+    module = TorchDinov2(model).eval()
+    ps = module.patch_size
+    pixel_values = torch.zeros(1, 3, 16 * ps, 16 * ps)
+    pos_embed = torch.from_numpy(np.asarray(model.embeddings.interpolate_pos_encoding(None, 16 * ps, 16 * ps), dtype=np.float32))
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            (pixel_values, pos_embed),
+            path,
+            input_names=["pixel_values", "pos_embed"],
+            output_names=["cls"],
+            dynamic_axes={
+                "pixel_values": {0: "batch", 2: "height", 3: "width"},
+                "pos_embed": {1: "num_tokens"},
+                "cls": {0: "batch"},
+            },
+            opset_version=opset_version,
+        )
+    return path
@@ -23,10 +23,19 @@ settings = get_settings()
 class FaissService(LoggerMixin):
     """Faiss索引服务类"""
     
-    def __init__(self):
+    def __init__(self, feature_dim: Optional[int] = None):
+        """
+        Args:
+            feature_dim: 模型实际输出的特征维度（ModelService 从权重推断），
+                         提供时以它为准并校验已有索引的维度
+        """
         self.index = None
         self.index_path = settings.faiss.index_path
-        self.feature_dim = settings.faiss.feature_dim
+        self.feature_dim = feature_dim or settings.faiss.feature_dim
+        if feature_dim and feature_dim != settings.faiss.feature_dim:
+            self.logger.warning(
+                f"配置的 feature_dim={settings.faiss.feature_dim} 与模型输出维度 {feature_dim} 不一致，以模型为准"
+            )
         self.index_type = settings.faiss.index_type
         self.executor = ThreadPoolExecutor(max_workers=2)
         self.id_mapping = {}  # faiss_id -> image_id 的映射
@@ -60,6 +69,11 @@ class FaissService(LoggerMixin):
             # 加载现有索引
             self.logger.info(f"加载现有索引: {self.index_path}")
             self.index = faiss.read_index(self.index_path)
+            if self.index.d != self.feature_dim:
+                raise ValueError(
+                    f"已有索引维度 {self.index.d} 与模型特征维度 {self.feature_dim} 不一致，"
+                    f"请删除 {self.index_path} 后重建索引"
+                )
             
             # 加载ID映射
             mapping_path = self.index_path.replace('.index', '_mapping.pkl')
@@ -13,20 +13,95 @@ import os
 
 from ..core.config import get_settings
 from ..utils.logger import LoggerMixin
-from ..dino.dinov2_numpy import Dinov2Numpy
+from ..dino.dinov2_numpy import (
+    Dinov2Numpy,
+    Profiler,
+    common_patch_grids,
+    infer_config,
+    is_prepared_weights,
+    load_int8_weights,
+    load_weights,
+    mmap_weights_path,
+)
 from ..dino.preprocess_image import resize_short_side
+from ..dino.backends import create_backend, validate_backend
+from ..dino.pipeline import FeaturePipeline
 
 settings = get_settings()
 
 
+class MicroBatcher:
+    """
+    动态微批：在 window_ms 内收集并发的单张推理请求，按输入形状（即 patch 网格）分组，
+    某组凑满 max_batch_size 或窗口到期时，在 executor 中对该组做一次批量前向，再把各行结果交给对应请求。
+
+    同形状的图像直接堆叠成 (B, C, H, W)，不需要 padding，每张图的结果与单独前向一致；
+    低负载时每个请求最多多等 window_ms，高负载时批次被请求填满，吞吐随 batch 提升。
+    """
+
+    def __init__(self, infer_fn, executor, window_ms: float = 8.0, max_batch_size: int = 8):
+        self.infer_fn = infer_fn
+        self.executor = executor
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pending = {}  # 输入形状 -> [(pixel_values, future), ...]
+        self.timers = {}
+        self.tasks = set()
+        self.stats = {"batches": 0, "items": 0}
+
+    async def submit(self, pixel_values: np.ndarray) -> np.ndarray:
+        """提交 (1, C, H, W) 输入，返回该图像的 (D,) 结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = pixel_values.shape[1:]
+        group = self.pending.setdefault(key, [])
+        group.append((pixel_values, future))
+        if len(group) >= self.max_batch_size:
+            self._flush(key)
+        elif len(group) == 1:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        group = self.pending.pop(key, None)
+        if group:
+            task = asyncio.ensure_future(self._run(group))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, group):
+        try:
+            features = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.infer_fn, np.concatenate([p for p, _ in group], axis=0)
+            )
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.stats["batches"] += 1
+        self.stats["items"] += len(group)
+        for (_, future), feature in zip(group, features):
+            if not future.done():  # 调用方已取消（如请求超时）时跳过
+                future.set_result(feature)
+
+
 class ModelService(LoggerMixin):
     """模型服务类"""
     
     def __init__(self):
         self.model = None
+        self.backend = None
         self.weights = None
         self.executor = ThreadPoolExecutor(max_workers=2)
+        # 微批的批量前向在单独的线程中串行执行，不与预处理争用 executor（BLAS 本身已多线程）
+        self.infer_executor = ThreadPoolExecutor(max_workers=1)
+        self.batcher = None
         self.feature_dim = settings.faiss.feature_dim
+        self.patch_size = settings.model.patch_size
         
     async def initialize(self):
         """初始化模型"""
@@ -48,7 +123,7 @@ class ModelService(LoggerMixin):
         """加载模型（在线程池中执行）"""
         # 检查权重文件是否存在
         weights_path = settings.model.weights_path
-        if not os.path.exists(weights_path):
+        if not os.path.exists(weights_path) and not os.path.exists(mmap_weights_path(weights_path)):
             # 尝试从项目根目录加载
             alternative_path = os.path.join(
                 os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))),
@@ -61,13 +136,96 @@ class ModelService(LoggerMixin):
         
         self.logger.info(f"正在加载DINOv2权重文件: {weights_path}")
         
-        # 加载.npz权重文件
-        self.weights = np.load(weights_path, allow_pickle=True)
+        # 加载权重：优先只读 mmap 准备好的 .mmap 文件（多 worker 共享 page cache），否则加载 .npz；
+        # .mmap 转换时的精度/量化策略与配置不一致时改用 .npz（无 .npz 则报错）
+        self.weights = load_weights(
+            weights_path,
+            dtype=settings.model.dtype,
+            weight_dtype=settings.model.weight_dtype,
+            quantization=settings.model.quantization,
+        )
         
-        # 初始化DINOv2模型
-        self.model = Dinov2Numpy(self.weights)
+        # int8 量化权重：首次从 .npz 计算并保存在其旁边，之后直接加载
+        qweights = None
+        if settings.model.quantization == "int8" and not is_prepared_weights(self.weights):
+            self.logger.info("使用 int8 weight-only 量化的 Linear 层")
+            qweights = load_int8_weights(weights_path, self.weights)
         
-        self.logger.info(f"DINOv2模型加载成功，特征维度: {self.feature_dim}")
+        # 模型结构（hidden_size / num_heads / num_layers / patch_size）从权重推断，
+        # 因此 ViT-S/14、ViT-B/14 等权重都可直接使用
+        model_config = infer_config(self.weights)
+        if model_config["patch_size"] != settings.model.patch_size:
+            self.logger.warning(
+                f"配置的 patch_size={settings.model.patch_size} 与权重不一致，使用权重中的 {model_config['patch_size']}"
+            )
+        self.patch_size = model_config["patch_size"]
+        
+        # 初始化DINOv2模型，并为常见宽高比预计算插值后的位置编码
+        self.model = Dinov2Numpy(
+            self.weights,
+            config=model_config,
+            pos_grids=common_patch_grids(settings.model.target_size, self.patch_size),
+            dtype=settings.model.dtype,
+            weight_dtype=settings.model.weight_dtype,
+            qweights=qweights,
+            attention=settings.model.attention,
+            attention_block_size=settings.model.attention_block_size,
+            attention_tile_threshold=settings.model.attention_tile_threshold,
+            workspace_max_mb=settings.model.workspace_max_mb,
+            token_merge_r=settings.model.token_merge_r,
+            fused_kernels=settings.model.fused_kernels,
+            num_threads=settings.model.num_threads
+        )
+        
+        # 特征维度以模型实际输出为准
+        if model_config["hidden_size"] != self.feature_dim:
+            self.logger.warning(
+                f"配置的 feature_dim={self.feature_dim} 与模型输出维度 {model_config['hidden_size']} 不一致，"
+                f"以模型为准"
+            )
+        self.feature_dim = model_config["hidden_size"]
+        
+        self.backend = self._create_backend(weights_path)
+        
+        if settings.model.micro_batch_window_ms > 0 and settings.model.micro_batch_max_size > 1:
+            self.batcher = MicroBatcher(
+                self._infer_normalized,
+                self.infer_executor,
+                window_ms=settings.model.micro_batch_window_ms,
+                max_batch_size=settings.model.micro_batch_max_size
+            )
+        
+        if settings.model.profile:
+            self.enable_profiling(True)
+        
+        self.logger.info(
+            f"DINOv2模型加载成功，结构: {model_config}, 特征维度: {self.feature_dim}, "
+            f"推理后端: {self.backend.name}, "
+            f"计算精度: {settings.model.dtype}, 权重存储精度: {settings.model.weight_dtype or settings.model.dtype}"
+        )
+    
+    def _create_backend(self, weights_path: str):
+        """按配置创建推理后端；非 numpy 后端不可用或校验不通过时回退到 numpy"""
+        name = settings.model.backend
+        kwargs = dict(batch_size=settings.model.batch_size, num_threads=settings.model.num_threads)
+        if name != "numpy":
+            try:
+                backend = create_backend(name, self.model, weights_path, device=settings.model.device, **kwargs)
+                if settings.model.validate_backend:
+                    demo_dir = os.path.join(
+                        os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))),
+                        "demo_data"
+                    )
+                    result = validate_backend(backend, demo_dir)
+                    self.logger.info(f"推理后端 {name} 校验结果: {result}")
+                    if result is not None and not result["passed"]:
+                        raise ValueError(f"与参考特征不一致: {result}")
+                return backend
+            except Exception as e:
+                self.logger.warning(f"推理后端 {name} 不可用（{e}），回退到 numpy")
+        elif settings.model.device != "cpu":
+            self.logger.info(f"numpy 后端只在 CPU 上推理（配置的 device={settings.model.device} 不生效）")
+        return create_backend("numpy", self.model, weights_path, **kwargs)
     
     async def extract_features(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
         """
@@ -80,53 +238,45 @@ class ModelService(LoggerMixin):
             特征向量数组
         """
         try:
-            # 在线程池中处理图像
-            features = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._extract_features_sync, image_input
+            if self.batcher is None:
+                # 在线程池中处理图像
+                return await asyncio.get_event_loop().run_in_executor(
+                    self.executor, self._extract_features_sync, image_input
+                )
+            # 预处理在线程池中并行，前向交给微批：并发请求中相同分辨率的合并为一次批量前向
+            pixel_values = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._preprocess, image_input
             )
-            return features
+            return await self.batcher.submit(pixel_values)
         except Exception as e:
             self.logger.error(f"特征提取失败: {e}")
             raise
     
+    def _preprocess(self, image_input: Union[str, Image.Image, bytes, np.ndarray]) -> np.ndarray:
+        """
+        将各种输入（文件路径、字节数据、文件对象、ndarray、PIL Image）预处理为 (1, C, H, W) 张量。
+        直接在内存中解码，不再写临时文件；大 JPEG 按接近目标尺寸的 DCT 缩放解码
+        """
+        return resize_short_side(
+            image_input,
+            target_size=settings.model.target_size,
+            patch_size=self.patch_size,
+            dtype=settings.model.dtype,
+            resize=settings.model.resize
+        )
+    
+    def _infer_normalized(self, pixel_values: np.ndarray) -> np.ndarray:
+        """(B, C, H, W) -> L2 归一化的 (B, D)（微批的批量前向）"""
+        features = self.backend(pixel_values)
+        return features / np.linalg.norm(features, axis=1, keepdims=True)
+    
     def _extract_features_sync(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
         """同步提取特征（在线程池中执行）"""
         # 加载图像
-        if isinstance(image_input, str):
-            # 文件路径
-            pixel_values = resize_short_side(
-                image_input,
-                target_size=settings.model.target_size,
-                patch_size=settings.model.patch_size
-            )
-        elif isinstance(image_input, bytes):
-            # 字节数据
-            # 先保存为临时文件，再使用resize_short_side
-            temp_path = "temp_image.jpg"
-            with open(temp_path, 'wb') as f:
-                f.write(image_input)
-            pixel_values = resize_short_side(
-                temp_path,
-                target_size=settings.model.target_size,
-                patch_size=settings.model.patch_size
-            )
-            os.remove(temp_path)
-        elif isinstance(image_input, Image.Image):
-            # PIL Image对象
-            # 先保存为临时文件，再使用resize_short_side
-            temp_path = "temp_image.jpg"
-            image_input.save(temp_path, format='JPEG')
-            pixel_values = resize_short_side(
-                temp_path,
-                target_size=settings.model.target_size,
-                patch_size=settings.model.patch_size
-            )
-            os.remove(temp_path)
-        else:
-            raise ValueError(f"不支持的图像输入类型: {type(image_input)}")
+        pixel_values = self._preprocess(image_input)
         
         # 提取特征
-        features = self.model(pixel_values)  # (1, D)
+        features = self.backend(pixel_values)  # (1, D)
         features = features.squeeze()  # (D,)
         
         # 确保特征维度正确
@@ -140,6 +290,25 @@ class ModelService(LoggerMixin):
         
         return features
     
+    async def extract_outputs(self, image_input: Union[str, Image.Image, bytes], outputs: List[str]) -> dict:
+        """
+        一次前向提取多种特征（CLS、mean / GeM pooling、中间层、patch 网格），
+        outputs 格式见 dinov2_numpy.parse_output_spec，如 ["cls", "gem", "layer8.mean", "patch"]。
+        结果去掉 batch 维，始终由 numpy 参考实现计算。
+        """
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._extract_outputs_sync, image_input, outputs
+            )
+        except Exception as e:
+            self.logger.error(f"多输出特征提取失败: {e}")
+            raise
+    
+    def _extract_outputs_sync(self, image_input: Union[str, Image.Image, bytes], outputs: List[str]) -> dict:
+        """同步提取多输出特征（在线程池中执行）"""
+        pixel_values = self._preprocess(image_input)
+        return {name: value[0] for name, value in self.model(pixel_values, outputs=outputs).items()}
+    
     async def extract_batch_features(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> np.ndarray:
         """
         批量提取图像特征
@@ -160,24 +329,55 @@ class ModelService(LoggerMixin):
             raise
     
     def _extract_batch_features_sync(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> List[np.ndarray]:
-        """同步批量提取特征（在线程池中执行）"""
+        """同步批量提取特征（在线程池中执行）：解码/预处理与推理流水线重叠"""
         features_list = []
-        batch_size = settings.model.batch_size
         
-        for i in range(0, len(image_inputs), batch_size):
-            batch = image_inputs[i:i + batch_size]
-            
-            for image_input in batch:
-                try:
-                    # 提取单个图像特征
-                    feature = self._extract_features_sync(image_input)
-                    features_list.append(feature)
-                except Exception as e:
-                    self.logger.warning(f"处理图像失败: {e}")
-                    continue
+        def load(image_input):
+            return self._preprocess(image_input), None
+        
+        def infer(pixel_batch):
+            # 分辨率各异的图像以 list 形式送入后端（numpy 走 padded batch，其他后端按分辨率分组）
+            features = self.backend(pixel_batch)  # (B, D)
+            return features / np.linalg.norm(features, axis=1, keepdims=True)
         
+        def write(features, _):
+            features_list.extend(features)
+        
+        def skip(image_input, e):
+            self.logger.warning(f"处理图像失败: {e}")
+        
+        pipeline = FeaturePipeline(
+            load, infer, write,
+            batch_size=settings.model.batch_size,
+            num_workers=settings.model.preprocess_workers,
+            on_error=skip
+        )
+        pipeline.run(image_inputs)
         return features_list
     
+    def enable_profiling(self, enabled: bool = True, track_memory: bool = True):
+        """开启/关闭模型的逐层剖析"""
+        if self.model is None:
+            raise RuntimeError("模型未初始化")
+        if enabled:
+            # 先关闭旧的剖析器，再创建新的（两者共享 tracemalloc）
+            self.model.disable_profiling()
+            self.model.enable_profiling(Profiler(track_memory=track_memory))
+            self.logger.info("已开启模型逐层剖析")
+        else:
+            self.model.disable_profiling()
+            self.logger.info("已关闭模型逐层剖析")
+    
+    def get_profile_report(self, reset: bool = False) -> Optional[dict]:
+        """获取逐层剖析报告，未开启剖析时返回 None"""
+        profiler = self.model.profiler if self.model is not None else None
+        if profiler is None:
+            return None
+        report = profiler.report()
+        if reset:
+            profiler.reset()
+        return report
+    
     def get_feature_dim(self) -> int:
         """获取特征维度"""
         return self.feature_dim
@@ -192,6 +392,8 @@ class ModelService(LoggerMixin):
             self.logger.info("正在清理模型服务资源...")
             if hasattr(self, 'executor'):
                 self.executor.shutdown(wait=True)
+            if hasattr(self, 'infer_executor'):
+                self.infer_executor.shutdown(wait=True)
             
             self.logger.info("模型服务资源清理完成")
         except Exception as e:
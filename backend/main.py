@@ -43,8 +43,8 @@ async def lifespan(app: FastAPI):
     await model_service.initialize()
     app.state.model_service = model_service
     
-    # 初始化Faiss服务
-    faiss_service = FaissService()
+    # 初始化Faiss服务（特征维度以模型实际输出为准）
+    faiss_service = FaissService(feature_dim=model_service.get_feature_dim())
     await faiss_service.initialize()
     app.state.faiss_service = faiss_service
     
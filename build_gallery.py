@@ -1,85 +1,382 @@
 import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import numpy as np
-import json
 from tqdm import tqdm
 
 # 引入你的模型和预处理
-from dinov2_numpy import Dinov2Numpy
+from dinov2_numpy import Dinov2Numpy, load_weights, mmap_weights_path
 from preprocess_image import resize_short_side
+from pipeline import FeaturePipeline
+from gallery_store import (
+    FEATURE_FILE,
+    MAP_FILE,
+    SEARCH_DTYPES,
+    TABLE_FILE,
+    ManifestJournal,
+    append_rows,
+    export_search_features,
+    file_sha1,
+    journal_path,
+    live_rows,
+    load_manifest,
+    npy_shape,
+    save_manifest,
+    save_metadata_table,
+    save_rows,
+    search_feature_paths,
+    truncate_rows,
+)
+
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg', '.webp')
+WEIGHTS_PATH = "vit-dinov2-base.npz"  # 请确保你有这个文件，或者用 small 版本
+COPY_CHUNK_ROWS = 65536
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
 
 def safe_mkdir(path: str):
     os.makedirs(path, exist_ok=True)
 
-def build_gallery(gallery_dir="gallery", target_size=224, patch_size=14):
-    images_dir = os.path.join(gallery_dir, "images")
-    safe_mkdir(gallery_dir)
+def remove_files(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def remove_search_files(gallery_dir, feat_path):
+    """
+    删除由清单 / features.npy 导出的检索文件（元数据表与低精度特征）。
+    特征行号将要改变（全量重建、compact）时先删除，构建中途 search_cli 会从清单重新导出，
+    而不是用旧的行号去对应新写入的特征行。
+    """
+    remove_files(os.path.join(gallery_dir, TABLE_FILE))
+    for dtype in SEARCH_DTYPES:
+        remove_files(*[path for path in search_feature_paths(feat_path, dtype) if path is not None])
+
+def truncate_search_files(feat_path, num_rows):
+    """
+    把已导出的低精度检索特征截断到 num_rows 行：中断的构建追加、但清单未记录的行可能已被
+    search_cli 导出，之后新图片会写入同样的行号，而导出只补齐末尾新增的行
+    """
+    for dtype in SEARCH_DTYPES:
+        for path in search_feature_paths(feat_path, dtype):
+            if path is not None and os.path.exists(path):
+                truncate_rows(path, num_rows)
 
-    # 1. 加载模型
+def load_gallery_rows(feat_path, map_path):
+    """
+    读取清单并与 features.npy 对齐：
+    - 特征行数多于清单（上次构建在写 checkpoint 前中断）：截掉多出的行（包括已导出的低精度特征）
+    - 特征行数少于清单或文件缺失：清单不可信，返回空列表（全量重建）
+    """
+    rows = load_manifest(map_path)
+    if not os.path.exists(feat_path):
+        if rows:
+            print(f"⚠️ {feat_path} 不存在，全量重建")
+            remove_files(map_path, journal_path(map_path))
+        return []
+    num_rows = npy_shape(feat_path)[0]
+    if num_rows > len(rows):
+        print(f"[INFO] Dropping {num_rows - len(rows)} feature rows from an interrupted run")
+        truncate_rows(feat_path, len(rows))
+    elif num_rows < len(rows):
+        print(f"⚠️ {feat_path} 只有 {num_rows} 行，少于清单的 {len(rows)} 条，全量重建")
+        remove_files(feat_path, map_path, journal_path(map_path))
+        return []
+    truncate_search_files(feat_path, len(rows))
+    return rows
+
+def load_model(weights_path=WEIGHTS_PATH):
     print("[INFO] Loading model...")
-    weights_path = "vit-dinov2-base.npz"  # 请确保你有这个文件，或者用 small 版本
-    if not os.path.exists(weights_path):
+    if not os.path.exists(weights_path) and not os.path.exists(mmap_weights_path(weights_path)):
         print(f"❌ 错误：权重文件 {weights_path} 不存在！")
-        return
-    
-    weights = np.load(weights_path)
+        return None
+
+    # 若已用 convert_weights.py 生成 .mmap 权重文件，则直接 mmap 加载（多进程构建时各进程共享 page cache）
+    weights = load_weights(weights_path)
     model = Dinov2Numpy(weights)
     print("[INFO] Model loaded.")
+    return model
+
+def embed_items(model, items, feat_path, rows, journal, target_size=224, patch_size=14, batch_size=16,
+                num_workers=2, desc="Processing Images", position=None):
+    """
+    提取 items（(文件名, 清单记录) 列表）的特征，逐批追加到 feat_path，并把成功的记录追加到 rows。
+    流水线处理：num_workers 个线程解码/预处理，与推理重叠；写线程把每批特征直接追加到 .npy，
+    再把这批记录写入 journal（checkpoint），内存占用与图片总数无关
+    """
+    # resize_short_side 会产生不同分辨率的图片，无法直接 np.stack；
+    # 这里把一批张量以 list 形式交给模型，走 padded batch 模式（token 补齐 + key padding mask），
+    # 每张图的特征与逐张推理一致。
+    def load(item):
+        img_name, row = item
+        # 预处理 -> (1, 3, H, W) 其中 H, W 动态变化
+        return resize_short_side(row["path"], target_size, patch_size), row
+
+    def infer(batch_inputs):
+        # 推理 -> (B, 768)
+        features = model(batch_inputs).astype(np.float32)
+
+        # 归一化 (L2 Norm)
+        norm = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / (norm + 1e-6)
+
+    pbar = tqdm(total=len(items), desc=desc, position=position)
+
+    def write(features, batch_rows):
+        append_rows(feat_path, features, sync=True)
+        journal.append(batch_rows)
+        rows.extend(batch_rows)
+        pbar.update(len(batch_rows))
+
+    def skip(item, e):
+        # 失败的图片不写入清单，下次构建会重试
+        print(f"Skipping {item[0]}: {e}")
+        pbar.update(1)
+
+    pipeline = FeaturePipeline(load, infer, write, batch_size=batch_size, num_workers=num_workers, on_error=skip)
+    try:
+        return pipeline.run(items)
+    finally:
+        pbar.close()
+
+def shard_paths(shard_dir, shard_idx):
+    base = os.path.join(shard_dir, f"shard-{shard_idx:04d}")
+    return base + ".npy", base + ".json"
+
+def embed_shard(shard_idx, items, shard_dir, target_size=224, patch_size=14, batch_size=16, num_workers=2):
+    """
+    在子进程中执行：加载自己的模型实例，把分片特征与清单写到 shard_dir，返回 (分片路径, 统计)。
+    分片同样逐批写 journal，进程中断后已完成的批次会在下次构建开始时合并
+    """
+    feat_path, map_path = shard_paths(shard_dir, shard_idx)
+    remove_files(feat_path, map_path, journal_path(map_path))
+    model = load_model()
+    if model is None:
+        raise FileNotFoundError(f"权重文件 {WEIGHTS_PATH} 不存在")
+    rows = []
+    with ManifestJournal(map_path) as journal:
+        stats = embed_items(model, items, feat_path, rows, journal, target_size, patch_size, batch_size,
+                            num_workers, desc=f"shard {shard_idx}", position=shard_idx)
+    save_manifest(map_path, rows)
+    return (feat_path, map_path), stats
+
+def leftover_shards(shard_dir):
+    """上次多进程构建中断后留下的分片（按分片顺序）"""
+    if not os.path.isdir(shard_dir):
+        return []
+    names = sorted(name for name in os.listdir(shard_dir) if name.endswith(".npy"))
+    return [shard_paths(shard_dir, int(name[len("shard-"):-len(".npy")])) for name in names]
+
+def merge_shards(paths, feat_path, rows, journal, chunk_rows=65536):
+    """按分片顺序把各分片的特征追加到 feat_path、记录追加到 rows 与 journal，随后删除分片文件"""
+    for shard_feat_path, shard_map_path in paths:
+        shard_rows = load_manifest(shard_map_path)
+        if shard_rows and os.path.exists(shard_feat_path):
+            # 分片可能多出未写 checkpoint 的特征行，只取清单覆盖的部分
+            features = np.load(shard_feat_path, mmap_mode="r")[:len(shard_rows)]
+            shard_rows = shard_rows[:features.shape[0]]
+            for start in range(0, len(shard_rows), chunk_rows):
+                append_rows(feat_path, features[start:start + chunk_rows], sync=True)
+            del features
+            journal.append(shard_rows)
+            rows.extend(shard_rows)
+        remove_files(shard_feat_path, shard_map_path, journal_path(shard_map_path))
+
+@contextmanager
+def blas_threads_env(num_threads):
+    """临时设置 BLAS/OpenMP 线程数环境变量（对之后启动的子进程生效）"""
+    if not num_threads:
+        yield
+        return
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+    os.environ.update({name: str(num_threads) for name in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def build_gallery(gallery_dir="gallery", target_size=224, patch_size=14, batch_size=16, num_workers=2,
+                  full=False, compact=False, processes=1, blas_threads=None, search_dtype=None):
+    """
+    增量构建图库：images_map.json 为每一行特征记录 (path, size, mtime, sha1)，
+    只对新增或内容变化的图片提取特征并追加到 features.npy，已删除的图片打 tombstone。
+    full=True 时忽略已有结果全量重建；compact=True 时在结束前清除 tombstone 行。
+    processes>1 时把待处理图片切成分片，由多个进程（各自一个模型实例、blas_threads 个 BLAS 线程）并行处理后合并。
+    search_dtype 为 "float16" / "int8" 时同时导出检索用的低精度特征（search_cli.py --dtype）。
+    """
+    images_dir = os.path.join(gallery_dir, "images")
+    safe_mkdir(gallery_dir)
+    feat_path = os.path.join(gallery_dir, FEATURE_FILE)
+    map_path = os.path.join(gallery_dir, MAP_FILE)
 
     if not os.path.exists(images_dir):
         print(f"❌ 错误：图片目录 {images_dir} 不存在！请创建并放入图片。")
         return
 
-    image_files = [f for f in os.listdir(images_dir) if f.lower().endswith(('.jpg', '.png', '.jpeg', '.webp'))]
+    image_files = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(IMAGE_EXTS))
     print(f"[INFO] Found {len(image_files)} images.")
-    
-    all_features = []
-    meta_data = []
-    
-    # 2. 逐张处理 (Batch Size = 1)
-    # 注意：因为 resize_short_side 会产生不同分辨率的图片，无法使用 np.stack 进行 batch 处理
-    # 除非进行 padding，但这里为了简单直接逐张跑。
-    for img_name in tqdm(image_files, desc="Processing Images"):
+
+    # 1. 对比清单，找出需要提取特征的图片
+    shard_dir = os.path.join(gallery_dir, "shards")
+    if full:
+        remove_files(feat_path, map_path, journal_path(map_path))
+        for shard_feat_path, shard_map_path in leftover_shards(shard_dir):
+            remove_files(shard_feat_path, shard_map_path, journal_path(shard_map_path))
+    rows = load_gallery_rows(feat_path, map_path)
+    if not rows:
+        # 从头构建（--full、清单与特征不一致）：旧的元数据表与低精度特征的行号已失效
+        remove_search_files(gallery_dir, feat_path)
+    # 上次多进程构建中断时各分片已完成的批次先合并，不必重新提取
+    shards_left = leftover_shards(shard_dir)
+    if shards_left:
+        print(f"[INFO] Merging {len(shards_left)} shards left by an interrupted run")
+        with ManifestJournal(map_path) as journal:
+            merge_shards(shards_left, feat_path, rows, journal)
+        save_manifest(map_path, rows)
+    if os.path.isdir(shard_dir) and not os.listdir(shard_dir):
+        os.rmdir(shard_dir)
+
+    by_path = {}
+    for i, row in enumerate(rows):
+        if row.get("deleted"):
+            continue
+        # 中断的构建可能已 checkpoint 了变化后图片的新行，而旧行的 tombstone 还没保存
+        if row["path"] in by_path:
+            rows[by_path[row["path"]]]["deleted"] = True
+        by_path[row["path"]] = i
+    # tombstone 行的特征在 compact 前仍在 features.npy 中，内容相同的图片（改名、复制、改回）可直接复用
+    by_sha1 = {row["sha1"]: i for i, row in enumerate(rows) if row.get("sha1")}
+
+    to_embed = []   # 需要推理的 (文件名, 清单记录)
+    to_copy = []    # 可复用已有特征的 (源行号, 清单记录)
+    num_unchanged = 0
+    num_deleted = 0
+    for img_name in tqdm(image_files, desc="Scanning"):
         img_path = os.path.join(images_dir, img_name)
-        
-        try:
-            # 预处理 -> (1, 3, H, W) 其中 H, W 动态变化
-            input_tensor = resize_short_side(img_path, target_size, patch_size)
-            
-            # 推理 -> (1, 768)
-            feature = model(input_tensor).astype(np.float32)
-            
-            # 归一化 (L2 Norm)
-            norm = np.linalg.norm(feature, axis=1, keepdims=True)
-            feature = feature / (norm + 1e-6)
-            
-            all_features.append(feature)
-            meta_data.append({
-                "filename": img_name,
-                "path": img_path
-            })
-            
-        except Exception as e:
-            print(f"Skipping {img_name}: {e}")
-
-    # 3. 保存结果
-    if all_features:
-        # vstack 将 list of (1, 768) 变成 (N, 768)
-        final_features = np.vstack(all_features)
-        
-        feat_path = os.path.join(gallery_dir, "features.npy")
-        map_path = os.path.join(gallery_dir, "images_map.json")
-        
-        np.save(feat_path, final_features)
-        
-        # 保存元数据列表
-        with open(map_path, "w", encoding="utf-8") as f:
-            json.dump(meta_data, f, ensure_ascii=False, indent=2)
-            
-        print(f"✅ Done! Gallery built.")
-        print(f"   Features shape: {final_features.shape}")
+        stat = os.stat(img_path)
+        i = by_path.pop(img_path, None)
+        if i is not None:
+            row = rows[i]
+            if row.get("size") == stat.st_size and row.get("mtime") == stat.st_mtime:
+                num_unchanged += 1
+                continue
+            sha1 = file_sha1(img_path)
+            # 只有 size/mtime 变化（touch、拷贝）时不必重算；旧版清单没有 sha1，沿用已有特征
+            if row.get("sha1", sha1) == sha1:
+                row.update(size=stat.st_size, mtime=stat.st_mtime, sha1=sha1)
+                num_unchanged += 1
+                continue
+            row["deleted"] = True
+            num_deleted += 1
+        else:
+            sha1 = file_sha1(img_path)
+
+        row = {"filename": img_name, "path": img_path, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1}
+        if sha1 in by_sha1:
+            to_copy.append((by_sha1[sha1], row))
+        else:
+            to_embed.append((img_name, row))
+
+    # 图片已不存在的行
+    for i in by_path.values():
+        rows[i]["deleted"] = True
+        num_deleted += 1
+
+    print(
+        f"[INFO] {num_unchanged} unchanged, {len(to_embed)} to embed, "
+        f"{len(to_copy)} reused by content hash, {num_deleted} removed."
+    )
+
+    # 新记录逐批写入 journal（checkpoint），进程中断后重新运行即从最后完成的批次继续
+    with ManifestJournal(map_path) as journal:
+        for start in range(0, len(to_copy), COPY_CHUNK_ROWS):
+            chunk = to_copy[start:start + COPY_CHUNK_ROWS]
+            append_rows(feat_path, np.load(feat_path, mmap_mode="r")[[i for i, _ in chunk]], sync=True)
+            journal.append([row for _, row in chunk])
+            rows.extend(row for _, row in chunk)
+
+        # 2. 提取特征（没有需要推理的图片时跳过）
+        if len(to_embed) > 1 and processes > 1:
+            # 多进程：按顺序切成 processes 个分片，各进程写自己的分片文件，最后按分片顺序合并，
+            # 结果与单进程构建一致
+            processes = min(processes, len(to_embed))
+            safe_mkdir(shard_dir)
+            shards = [
+                to_embed[len(to_embed) * k // processes:len(to_embed) * (k + 1) // processes] for k in range(processes)
+            ]
+            print(f"[INFO] Embedding {len(to_embed)} images in {processes} processes "
+                  f"({blas_threads or 'default'} BLAS threads each)...")
+            done = [None] * processes
+            # 用 spawn 启动子进程（fork 已初始化的 BLAS 线程池可能死锁），BLAS 线程数须在子进程导入 numpy 前通过环境变量设定
+            with blas_threads_env(blas_threads), ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        embed_shard, k, shard, shard_dir, target_size, patch_size, batch_size, num_workers
+                    )
+                    for k, shard in enumerate(shards)
+                ]
+                for k, future in enumerate(futures):
+                    try:
+                        done[k], stats = future.result()
+                        print(f"[INFO] shard {k}: {stats['processed']} embedded, {stats['failed']} failed, "
+                              f"total {stats['elapsed_s']:.1f}s")
+                    except Exception as e:
+                        # 失败分片中的图片不写入清单，下次构建会重试
+                        print(f"⚠️ shard {k} failed: {e}")
+            merge_shards([paths for paths in done if paths is not None], feat_path, rows, journal)
+        elif to_embed:
+            model = load_model()
+            if model is None:
+                return
+            stats = embed_items(model, to_embed, feat_path, rows, journal, target_size, patch_size, batch_size,
+                                num_workers)
+            print(
+                f"[INFO] decode {stats['decode_s']:.1f}s (x{num_workers} workers), infer {stats['infer_s']:.1f}s, "
+                f"infer waited for decode {stats['wait_s']:.1f}s, total {stats['elapsed_s']:.1f}s"
+            )
+
+    # 3. 清除 tombstone 行（重写 features.npy 并重新编号）
+    live = live_rows(rows)
+    if compact and len(live) < len(rows):
+        remove_search_files(gallery_dir, feat_path)
+        save_rows(feat_path, np.load(feat_path, mmap_mode="r")[live])
+        print(f"[INFO] Compacted gallery, dropped {len(rows) - len(live)} rows")
+        rows = [rows[i] for i in live]
+
+    # 4. 保存清单，并导出检索用的元数据表
+    save_manifest(map_path, rows)
+    save_metadata_table(os.path.join(gallery_dir, TABLE_FILE), rows)
+    search_path = None
+    if search_dtype and os.path.exists(feat_path):
+        search_path = export_search_features(feat_path, search_dtype)
+    if len(live):
+        print(f"✅ Done! Gallery updated.")
+        print(f"   Features shape: {tuple(npy_shape(feat_path))} ({len(live)} live)")
         print(f"   Saved to: {feat_path}")
+        if search_path:
+            print(f"   Search features ({search_dtype}): {search_path}")
     else:
         print("⚠️ No features extracted.")
 
 if __name__ == "__main__":
-    build_gallery()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Incrementally build the image gallery features")
+    parser.add_argument("--gallery-dir", default="gallery")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="解码/预处理线程数")
+    parser.add_argument("--processes", type=int, default=1, help="推理进程数，每个进程一个模型实例")
+    parser.add_argument("--blas-threads", type=int, default=None, help="每个推理进程的 BLAS 线程数")
+    parser.add_argument("--full", action="store_true", help="忽略已有清单，全量重建")
+    parser.add_argument("--compact", action="store_true", help="清除已删除图片的 tombstone 行")
+    parser.add_argument("--search-dtype", choices=SEARCH_DTYPES, default=None,
+                        help="同时导出检索用的低精度特征（search_cli.py --dtype）")
+    args = parser.parse_args()
+    build_gallery(args.gallery_dir, batch_size=args.batch_size, num_workers=args.workers,
+                  full=args.full, compact=args.compact, processes=args.processes, blas_threads=args.blas_threads,
+                  search_dtype=args.search_dtype)
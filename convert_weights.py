@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from dinov2_numpy import (
+    Dinov2Numpy,
+    common_patch_grids,
+    load_int8_weights,
+    load_weights,
+    mmap_weights_path,
+    save_mmap_weights,
+)
+
+# 将 .npz 权重转换为可直接 mmap 的权重文件：
+#   - 未压缩、按 64 字节对齐、JSON header，加载时只读 mmap，不解压、不拷贝
+#   - 保存的是加载时准备好的权重（QKV 融合 / 转置 / 折叠缩放与 LayerScale / 可选量化）
+#   - 同时保存常见宽高比网格的插值位置编码
+# 同一台机器上的多个 worker 进程共享同一份 page cache。
+
+def convert_weights(weights_path, out_path=None, dtype="float32", weight_dtype=None, int8=False,
+                    target_size=224, patch_size=14):
+    if not os.path.exists(weights_path):
+        print(f"❌ 错误：权重文件 {weights_path} 不存在！")
+        return None
+    out_path = out_path or mmap_weights_path(weights_path)
+
+    print(f"[INFO] Loading {weights_path} ...")
+    weights = np.load(weights_path)
+    qweights = load_int8_weights(weights_path, weights) if int8 else None
+
+    print("[INFO] Preparing weights ...")
+    model = Dinov2Numpy(
+        weights,
+        pos_grids=common_patch_grids(target_size, patch_size),
+        dtype=dtype,
+        weight_dtype=weight_dtype,
+        qweights=qweights,
+    )
+    meta = {
+        "source": os.path.basename(weights_path),
+        "dtype": dtype,
+        "weight_dtype": weight_dtype,
+        "quantization": "int8" if int8 else None,
+    }
+    save_mmap_weights(model.export_prepared_weights(), out_path, meta=meta)
+    print(f"✅ Saved to: {out_path} ({os.path.getsize(out_path) / 1024 / 1024:.1f} MB)")
+
+    # 简单校验：mmap 加载速度与输出一致性
+    start = time.time()
+    mmap_weights = load_weights(out_path, dtype, weight_dtype, "int8" if int8 else None)
+    mmap_model = Dinov2Numpy(mmap_weights, dtype=dtype)
+    print(f"   mmap load time: {(time.time() - start) * 1000:.1f} ms")
+    pixel_values = np.random.default_rng(0).standard_normal((1, 3, target_size, target_size)).astype(dtype)
+    max_abs = np.max(np.abs(model(pixel_values) - mmap_model(pixel_values)))
+    print(f"   max_abs_diff vs in-memory model: {float(max_abs)}")
+    return out_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert .npz DINOv2 weights to a mmap-able weights file")
+    parser.add_argument("weights", nargs="?", default="vit-dinov2-base.npz")
+    parser.add_argument("--out", default=None, help="输出路径，默认与 .npz 同名的 .mmap")
+    parser.add_argument("--dtype", default="float32", help="计算精度")
+    parser.add_argument("--weight-dtype", default=None, help="Linear 权重存储精度，如 float16")
+    parser.add_argument("--int8", action="store_true", help="Linear 使用 per-channel int8 权重")
+    args = parser.parse_args()
+    if convert_weights(args.weights, args.out, args.dtype, args.weight_dtype, args.int8) is None:
+        sys.exit(1)
@@ -1,10 +1,83 @@
 import numpy as np
 
-from dinov2_numpy import Dinov2Numpy
-from preprocess_image import center_crop
+from dinov2_numpy import Dinov2Numpy, load_int8_weights
+from preprocess_image import center_crop, resize_short_side
+
+# (计算精度, 权重存储精度)
+PRECISION_POLICIES = [
+    ("float64", None),
+    ("float32", None),
+    ("float32", "float16"),
+]
+
+def precision_report(weights, ref):
+    """不同精度策略下的特征与参考特征的误差 / 余弦相似度对比"""
+    print("\n" + "=" * 50)
+    print("precision report (vs reference features)")
+    print("=" * 50)
+    for dtype, weight_dtype in PRECISION_POLICIES:
+        vit = Dinov2Numpy(weights, dtype=dtype, weight_dtype=weight_dtype)
+        feats = np.concatenate([
+            vit(center_crop("./demo_data/cat.jpg", dtype=dtype)),
+            vit(center_crop("./demo_data/dog.jpg", dtype=dtype)),
+        ], axis=0)
+        max_abs = np.max(np.abs(feats - ref))
+        cos = np.sum(feats * ref, axis=1) / (np.linalg.norm(feats, axis=1) * np.linalg.norm(ref, axis=1))
+        print(
+            f"compute={dtype:<8} weights={weight_dtype or dtype:<8} "
+            f"max_abs_diff={float(max_abs):.3e}  min_cosine={float(cos.min()):.6f}"
+        )
+
+def quantization_report(weights, weights_path):
+    """int8 weight-only 量化模型与 float32 模型 CLS 特征的余弦相似度"""
+    print("\n" + "=" * 50)
+    print("int8 quantization report (vs float32 CLS)")
+    print("=" * 50)
+    vit_fp32 = Dinov2Numpy(weights)
+    vit_int8 = Dinov2Numpy(weights, qweights=load_int8_weights(weights_path, weights))
+    for name in ["cat", "dog"]:
+        for preprocess in [center_crop, resize_short_side]:
+            pixel_values = preprocess(f"./demo_data/{name}.jpg")
+            a = vit_fp32(pixel_values)[0]
+            b = vit_int8(pixel_values)[0]
+            cos = np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+            print(f"{name:<4} {preprocess.__name__:<18} shape={pixel_values.shape}  cosine={float(cos):.6f}")
+
+def token_merge_report(weights, ref_vit):
+    """token merging：不同 r 下的耗时与 CLS 特征余弦相似度（相对 r=0）"""
+    import time
+    print("\n" + "=" * 50)
+    print("token merging report (resize_short_side, vs r=0)")
+    print("=" * 50)
+    pixel_values = [resize_short_side(f"./demo_data/{name}.jpg") for name in ["cat", "dog"]]
+    ref = np.concatenate([ref_vit(x) for x in pixel_values], axis=0)
+    for r in [0, 8, 16, 24]:
+        vit = Dinov2Numpy(weights, token_merge_r=r)
+        vit(pixel_values[0])  # 预热
+        start = time.perf_counter()
+        feats = np.concatenate([vit(x) for x in pixel_values], axis=0)
+        elapsed = (time.perf_counter() - start) / len(pixel_values)
+        cos = np.sum(feats * ref, axis=1) / (np.linalg.norm(feats, axis=1) * np.linalg.norm(ref, axis=1))
+        print(f"r={r:<3} {elapsed * 1000:8.1f} ms/img  min_cosine={float(cos.min()):.6f}")
+
+def profile_report(weights):
+    """逐层剖析：各子算子的耗时、占比、GFLOP/s 与新分配内存"""
+    print("\n" + "=" * 50)
+    print("profile report (resize_short_side, cat + dog)")
+    print("=" * 50)
+    vit = Dinov2Numpy(weights)
+    pixel_values = [resize_short_side(f"./demo_data/{name}.jpg") for name in ["cat", "dog"]]
+    for x in pixel_values:
+        vit(x)  # 预热：填充位置编码缓存与 workspace
+    profiler = vit.enable_profiling()
+    for x in pixel_values:
+        vit(x)
+    print(profiler.format_report())
+    vit.disable_profiling()
 
 def main():
-    weights = np.load("vit-dinov2-base.npz")
+    weights_path = "vit-dinov2-base.npz"
+    weights = np.load(weights_path)
     vit = Dinov2Numpy(weights)
 
     cat_pixel_values = center_crop("./demo_data/cat.jpg")
@@ -37,5 +110,25 @@ def main():
     else:
         print(f"[WARN] NOT within tolerance {tol}")
 
+    # padded batch 模式：不同分辨率的图像一次前向，结果应与逐张推理一致
+    batch_inputs = [
+        resize_short_side("./demo_data/cat.jpg"),
+        resize_short_side("./demo_data/dog.jpg"),
+    ]
+    single_feats = np.concatenate([vit(x) for x in batch_inputs], axis=0)
+    batch_feats = vit(batch_inputs)
+    batch_max_abs = np.max(np.abs(batch_feats - single_feats))
+    print("batch shapes:", [x.shape for x in batch_inputs])
+    print("batch_vs_single_max_abs_diff:", float(batch_max_abs))
+    if batch_max_abs < tol:
+        print(f"[OK] padded batch within tolerance {tol}")
+    else:
+        print(f"[WARN] padded batch NOT within tolerance {tol}")
+
+    precision_report(weights, ref)
+    quantization_report(weights, weights_path)
+    token_merge_report(weights, vit)
+    profile_report(weights)
+
 if __name__ == "__main__":
     main()
@@ -1,21 +1,715 @@
+import json
+import math
+import os
+import threading
+import time
+import tracemalloc
+import warnings
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+
 import numpy as np
 from scipy.ndimage import zoom
 
+try:
+    import numexpr
+except ImportError:  # numexpr 可选：未安装时 FusedKernels 的 GELU 使用分块 NumPy
+    numexpr = None
 
-def gelu(x):
-    # tanh-approx GELU (same as many transformer impls)
-    return 0.5 * x * (1.0 + np.tanh(np.sqrt(2.0 / np.pi) * (x + 0.044715 * np.power(x, 3))))
+# 常见图片宽高比（长边 / 短边），用于在加载模型时预计算位置编码
+COMMON_ASPECT_RATIOS = (1.0, 5 / 4, 4 / 3, 3 / 2, 16 / 10, 16 / 9, 2.0)
+
+# 每个 TransformerBlock 中 Linear 层的 key 后缀（后接 .weight / .bias）
+LINEAR_SUFFIXES = (
+    ".attention.attention.query",
+    ".attention.attention.key",
+    ".attention.attention.value",
+    ".attention.output.dense",
+    ".mlp.fc1",
+    ".mlp.fc2",
+)
+
+# 参与 int8 量化的 Linear 权重（占模型参数的绝大部分）
+QUANTIZED_WEIGHT_SUFFIXES = tuple(f"{suffix}.weight" for suffix in LINEAR_SUFFIXES)
 
+# mmap 权重文件：magic + 8 字节小端 header 长度 + JSON header + 按 MMAP_ALIGNMENT 对齐的张量数据
+MMAP_MAGIC = b"DINOMMAP"
+MMAP_ALIGNMENT = 64
 
-def softmax(x, axis=-1):
+# 预插值位置编码在权重文件中的 key 前缀：embeddings.position_embeddings.prepared.{h}x{w}
+POS_GRID_PREFIX = "embeddings.position_embeddings.prepared."
+
+
+def gelu(x, out=None, scratch=None):
+    # tanh-approx GELU (same as many transformer impls)
+    # 常数用 Python float，避免 NumPy float64 标量把 float32 输入提升为 float64
+    # out / scratch: 可选的与 x 同形状的缓冲区（out 可以就是 x），提供时不再分配新数组
+    t = np.multiply(x, x, out=scratch)
+    t *= 0.044715
+    t += 1.0
+    t *= x
+    t *= math.sqrt(2.0 / math.pi)
+    np.tanh(t, out=t)
+    t += 1.0
+    t *= 0.5
+    return np.multiply(x, t, out=out)
+
+
+def softmax(x, axis=-1, out=None):
+    # out: 可选的输出缓冲区（可以就是 x，原地计算）
     x_max = np.max(x, axis=axis, keepdims=True)
-    x_exp = np.exp(x - x_max)
-    x_sum = np.sum(x_exp, axis=axis, keepdims=True)
-    return x_exp / x_sum
+    out = np.subtract(x, x_max, out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=axis, keepdims=True)
+    return out
+
+
+_kernel_executors = {}
+_kernel_executors_lock = threading.Lock()
+
+
+def _kernel_executor(num_threads):
+    """按线程数共享的块并行线程池：每个模型实例各建一个线程池且无人关闭会一直占着线程"""
+    with _kernel_executors_lock:
+        executor = _kernel_executors.get(num_threads)
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = _kernel_executors[num_threads] = ThreadPoolExecutor(
+                max_workers=num_threads, thread_name_prefix="fused-kernels"
+            )
+        return executor
+
+
+class FusedKernels:
+    """
+    GELU / softmax / LayerNorm 的融合逐元素算子。
+
+    上面的 gelu / softmax 与 LayerNorm 每一步都扫一遍完整张量（(B, N, 4D) 的 GELU 约 8 遍），
+    属于访存瓶颈。这里把最后一维之外的行切成约 block_bytes 大小的块，每块在 cache 中完成全部步骤，
+    主存只读写一遍；多个块可交给线程池并行（NumPy ufunc 会释放 GIL）。
+    安装了 numexpr 时 GELU 由 numexpr 单表达式多线程求值。
+
+    num_threads: 块并行的线程数（同时设置 numexpr 的线程数），1 表示在调用线程中顺序执行；
+                 None 表示使用 os.cpu_count()，且不改动 numexpr 自身的（进程级）线程设置。
+                 线程数相同的实例共享同一个模块级线程池
+    block_bytes: 每块的目标字节数，默认 512KB（小于 L2）
+    """
+
+    def __init__(self, num_threads=None, block_bytes=512 * 1024):
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.block_bytes = block_bytes
+        self.executor = _kernel_executor(self.num_threads) if self.num_threads > 1 else None
+        if numexpr is not None and num_threads is not None:
+            numexpr.set_num_threads(self.num_threads)
+
+    def _run_blocks(self, fn, x):
+        """把 x（视为 (rows, last_dim)）按块调用 fn(start, stop)"""
+        rows = x.size // x.shape[-1] if x.size else 0
+        step = max(1, self.block_bytes // (x.shape[-1] * x.itemsize))
+        blocks = [(i, min(i + step, rows)) for i in range(0, rows, step)]
+        if self.executor is None or len(blocks) == 1:
+            for start, stop in blocks:
+                fn(start, stop)
+        else:
+            list(self.executor.map(lambda block: fn(*block), blocks))
+
+    @staticmethod
+    def _rows(x, out):
+        if out is None:
+            out = np.empty_like(x)
+        if not (x.flags.c_contiguous and out.flags.c_contiguous):
+            return None, None, out
+        return x.reshape(-1, x.shape[-1]), out.reshape(-1, x.shape[-1]), out
+
+    def gelu(self, x, out=None):
+        x2, out2, out = self._rows(x, out)
+        if x2 is None:
+            return gelu(x, out=out)
+        if numexpr is not None:
+            # 常数以 x.dtype 标量传入，避免 numexpr 把 float32 表达式提升为 float64
+            c = {name: x.dtype.type(value) for name, value in [
+                ("half", 0.5), ("one", 1.0), ("a", 0.044715), ("k", math.sqrt(2.0 / math.pi))
+            ]}
+            return numexpr.evaluate(
+                "half * x * (one + tanh(k * (x + a * x * x * x)))",
+                local_dict=dict(c, x=x), out=out, casting="same_kind",
+            )
+
+        def block(start, stop):
+            xb = x2[start:stop]
+            gelu(xb, out=out2[start:stop], scratch=np.empty_like(xb))
+
+        self._run_blocks(block, x)
+        return out
+
+    def softmax(self, x, out=None):
+        """沿最后一维的 softmax（out 可以就是 x）"""
+        x2, out2, out = self._rows(x, out)
+        if x2 is None:
+            return softmax(x, axis=-1, out=out)
+
+        def block(start, stop):
+            softmax(x2[start:stop], axis=-1, out=out2[start:stop])
+
+        self._run_blocks(block, x)
+        return out
+
+    def layer_norm(self, x, weight, bias, eps, out=None):
+        x2, out2, out = self._rows(x, out)
+        if x2 is None:
+            return LayerNorm(weight, bias, eps)(x, out=out)
+
+        def block(start, stop):
+            xb, ob = x2[start:stop], out2[start:stop]
+            mean = xb.mean(-1, keepdims=True)
+            np.subtract(xb, mean, out=ob)
+            var = np.einsum("...i,...i->...", ob, ob)[..., None]
+            var /= x.shape[-1]
+            var += eps
+            ob /= np.sqrt(var, out=var)
+            ob *= weight
+            ob += bias
+
+        self._run_blocks(block, x)
+        return out
+
+    def close(self):
+        # 线程池为共享的，不在这里 shutdown；之后在调用线程中顺序执行
+        self.executor = None
+
+
+def tiled_attention(q, k, v, bias=None, block_size=256, out=None):
+    """
+    分块注意力（online softmax）：按 query 块与 key 块循环，维护每行的运行最大值、归一化分母与输出累加，
+    峰值临时内存为 (B, H, block_size, block_size)，不再随 N² 增长。
+
+    q, k, v: (B, H, N, d)，缩放已折叠进 q
+    bias: 可选 (B, 1, 1, N) 的加性 key padding 偏置（0 / -inf）
+    out: 可选的 (B, H, N, d) 输出缓冲区
+    返回 (B, H, N, d)
+    """
+    N = q.shape[2]
+    if out is None:
+        out = np.empty_like(q)
+    k_t = k.transpose(0, 1, 3, 2)  # (B, H, d, N)
+    for i in range(0, N, block_size):
+        q_blk = q[:, :, i:i + block_size]
+        row_max = np.full(q_blk.shape[:-1] + (1,), -np.inf, dtype=q.dtype)
+        row_sum = np.zeros_like(row_max)
+        acc = np.zeros_like(q_blk)
+        # 第一个 key 块包含始终有效的 CLS，因此 row_max 在第一次迭代后即为有限值，不会出现 NaN
+        for j in range(0, N, block_size):
+            scores = np.matmul(q_blk, k_t[..., j:j + block_size])  # (B, H, bq, bk)
+            if bias is not None:
+                scores += bias[..., j:j + block_size]
+            new_max = np.maximum(row_max, scores.max(axis=-1, keepdims=True))
+            correction = np.exp(row_max - new_max)
+            scores -= new_max
+            np.exp(scores, out=scores)
+            row_sum *= correction
+            row_sum += scores.sum(axis=-1, keepdims=True)
+            acc *= correction
+            acc += np.matmul(scores, v[:, :, j:j + block_size])
+            row_max = new_max
+        np.divide(acc, row_sum, out=out[:, :, i:i + block_size])
+    return out
+
+
+def infer_config(weights, head_dim=64):
+    """
+    从权重张量形状推断模型结构：
+      - hidden_size / patch_size：patch projection 权重 (D, C, ps, ps)
+      - num_layers：encoder.layer.{i} 的个数
+      - num_heads：权重中无法直接体现，按 DINOv2 全系列 head_dim = 64 推断
+        （ViT-S/14: 384 -> 6, ViT-B/14: 768 -> 12, ViT-L/14: 1024 -> 16, ViT-g/14: 1536 -> 24）
+    """
+    proj_w = weights["embeddings.patch_embeddings.projection.weight"]
+    hidden_size = proj_w.shape[0]
+    layer_ids = {
+        int(key.split(".")[2])
+        for key in weights.keys()
+        if key.startswith("encoder.layer.") and key.endswith(".norm1.weight")
+    }
+    if hidden_size % head_dim != 0:
+        raise ValueError(f"hidden_size={hidden_size} is not divisible by head_dim={head_dim}")
+    return {
+        "hidden_size": hidden_size,
+        "num_heads": hidden_size // head_dim,
+        "num_layers": len(layer_ids),
+        "patch_size": proj_w.shape[-1],
+    }
+
+
+def common_patch_grids(target_size=224, patch_size=14, aspect_ratios=COMMON_ASPECT_RATIOS):
+    """
+    按 resize_short_side 的尺寸规则，计算常见宽高比（横/竖两个方向）对应的 patch 网格 (h, w)。
+    """
+    short = max(int(round(target_size / patch_size)), 1)
+    grids = []
+    for ratio in aspect_ratios:
+        long = max(int(round(int(round(target_size * ratio)) / patch_size)), 1)
+        for grid in ((short, long), (long, short)):
+            if grid not in grids:
+                grids.append(grid)
+    return grids
+
+
+def quantize_int8(weight):
+    """
+    按输出通道（行）对称量化：weight (out, in) -> (int8 (out, in), scale (out,) float32)，
+    满足 weight ≈ qweight * scale[:, None]。
+    """
+    weight = np.asarray(weight, dtype=np.float32)
+    scale = np.abs(weight).max(axis=1) / 127.0
+    scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+    qweight = np.clip(np.rint(weight / scale[:, None]), -127, 127).astype(np.int8)
+    return qweight, scale
+
+
+def quantize_weights(weights):
+    """
+    对所有 Linear 权重做 int8 量化。
+    返回 {key: int8 权重, key + ".scale": float32 每通道 scale}，可直接 np.savez 保存。
+    """
+    qweights = {}
+    for key in weights.keys():
+        if key.endswith(QUANTIZED_WEIGHT_SUFFIXES):
+            qweights[key], qweights[f"{key}.scale"] = quantize_int8(weights[key])
+    return qweights
+
+
+def int8_weights_path(weights_path):
+    """量化权重与原始 .npz 放在一起：xxx.npz -> xxx.int8.npz"""
+    return os.path.splitext(weights_path)[0] + ".int8.npz"
+
+
+def load_int8_weights(weights_path, weights=None):
+    """
+    加载 weights_path 旁边的 int8 量化权重；若不存在或比原始权重旧，则从原始权重重新计算并保存。
+    """
+    qpath = int8_weights_path(weights_path)
+    if not os.path.exists(qpath) or (
+        os.path.exists(weights_path) and os.path.getmtime(weights_path) > os.path.getmtime(qpath)
+    ):
+        if weights is None:
+            weights = np.load(weights_path)
+        np.savez(qpath, **quantize_weights(weights))
+    return dict(np.load(qpath))
+
+
+def mmap_weights_path(weights_path):
+    """mmap 权重文件与原始 .npz 放在一起：xxx.npz -> xxx.mmap"""
+    return os.path.splitext(weights_path)[0] + ".mmap"
+
+
+def save_mmap_weights(arrays, path, meta=None):
+    """
+    将 {key: ndarray} 写成单个未压缩、按 MMAP_ALIGNMENT 对齐的权重文件（JSON header + 原始字节），
+    可被 load_mmap_weights 只读 mmap，多进程共享同一份 page cache。
+    """
+    tensors = {}
+    offset = 0
+    for key, value in arrays.items():
+        value = np.asarray(value)
+        tensors[key] = {
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+            "offset": offset,
+        }
+        offset += -(-value.nbytes // MMAP_ALIGNMENT) * MMAP_ALIGNMENT
+
+    header = json.dumps({"meta": meta or {}, "tensors": tensors}).encode("utf-8")
+    # header 补空格，使数据区起点对齐
+    data_start = -(-(len(MMAP_MAGIC) + 8 + len(header)) // MMAP_ALIGNMENT) * MMAP_ALIGNMENT
+    header += b" " * (data_start - len(MMAP_MAGIC) - 8 - len(header))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MMAP_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for key, value in arrays.items():
+            f.seek(data_start + tensors[key]["offset"])
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_mmap_weights(path):
+    """
+    只读 mmap 加载 save_mmap_weights 写出的权重文件，返回 {key: 只读 ndarray 视图}，不拷贝数据。
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MMAP_MAGIC)) != MMAP_MAGIC:
+            raise ValueError(f"{path} is not a mmap weights file")
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = len(MMAP_MAGIC) + 8 + header_len
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    weights = {}
+    for key, info in header["tensors"].items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        weights[key] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + info["offset"]
+        ).reshape(shape)
+    return weights
+
+
+def mmap_weights_meta(path):
+    """读取 .mmap 权重文件 header 中记录的转换参数（source / dtype / weight_dtype / quantization）"""
+    with open(path, "rb") as f:
+        if f.read(len(MMAP_MAGIC)) != MMAP_MAGIC:
+            raise ValueError(f"{path} is not a mmap weights file")
+        header_len = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(header_len).decode("utf-8")).get("meta", {})
+
+
+def mmap_meta_mismatch(meta, dtype="float32", weight_dtype=None, quantization=None):
+    """返回 .mmap 转换参数与请求不一致的字段 {name: (文件中的值, 请求的值)}，一致时为空字典"""
+    def name(value):
+        return np.dtype(value).name if value else None
+
+    stored = {
+        "dtype": name(meta.get("dtype", "float32")),
+        "weight_dtype": name(meta.get("weight_dtype")),
+        "quantization": meta.get("quantization") or None,
+    }
+    requested = {"dtype": name(dtype), "weight_dtype": name(weight_dtype), "quantization": quantization or None}
+    return {key: (stored[key], requested[key]) for key in stored if stored[key] != requested[key]}
+
+
+def load_weights(weights_path, dtype="float32", weight_dtype=None, quantization=None):
+    """
+    加载模型权重：
+      - .mmap：只读 mmap（启动几乎零开销，多进程共享）
+      - .npz：若旁边有不旧于它的 .mmap 文件（或 .npz 本身不存在）则优先使用 .mmap，否则 np.load
+
+    .mmap 中的权重已按 convert_weights.py 转换时的 dtype / weight_dtype / quantization 准备好，
+    与这里请求的不一致时：旁边有 .npz 则警告并改用 .npz，否则报错（避免静默地用 int8 / float16 权重推理）。
+    """
+    if weights_path.endswith(".mmap"):
+        mmap_path, npz_path = weights_path, None
+    else:
+        mmap_path, npz_path = mmap_weights_path(weights_path), weights_path
+    has_npz = npz_path is not None and os.path.exists(npz_path)
+    if os.path.exists(mmap_path) and (not has_npz or os.path.getmtime(mmap_path) >= os.path.getmtime(npz_path)):
+        mismatch = mmap_meta_mismatch(mmap_weights_meta(mmap_path), dtype, weight_dtype, quantization)
+        if not mismatch:
+            return load_mmap_weights(mmap_path)
+        detail = ", ".join(f"{key}: {stored} != {requested}" for key, (stored, requested) in mismatch.items())
+        if not has_npz:
+            raise ValueError(f"{mmap_path} was converted with different settings ({detail}); re-run convert_weights.py")
+        warnings.warn(f"{mmap_path} was converted with different settings ({detail}); falling back to {npz_path}")
+    return np.load(npz_path, allow_pickle=True)
+
+
+def is_prepared_weights(weights):
+    """权重是否已是 export_prepared_weights 导出的准备后格式（如 mmap 权重文件）"""
+    return any(".prepared." in key for key in weights.keys())
+
+
+class Workspace:
+    """
+    一种 (B, N, dtype) 形状下前向所需的激活缓冲区集合，按名字复用。
+    各层通过 out= 参数与原地运算写入这些缓冲区，稳态推理几乎不再分配内存。
+    缓冲区以一维数组保存，请求更小的形状时返回其前缀视图（token merging 逐层缩短序列时无需重新分配）。
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        size = math.prod(shape)
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = np.empty(size, dtype=dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+
+class WorkspaceCache:
+    """
+    每个线程一个只增不减的 Workspace（ModelService 的线程池会并发调用同一个模型）。
+    Workspace.get 对更小的形状返回前缀视图，所以不同 (B, N) 的前向（padded batch 的 N 几乎每批不同）
+    共用同一组缓冲区，每个线程常驻的激活内存不超过单次最大前向所需。
+    max_bytes: 可选上限，一次前向后缓冲区总量超过该值时释放，下次前向重新分配
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    def get(self):
+        workspace = getattr(self._local, "workspace", None)
+        if workspace is None:
+            workspace = self._local.workspace = Workspace()
+        return workspace
+
+    def release(self):
+        """前向结束后调用：超过 max_bytes 时释放本线程的缓冲区"""
+        workspace = getattr(self._local, "workspace", None)
+        if workspace is not None and self.max_bytes is not None and workspace.nbytes > self.max_bytes:
+            workspace.buffers.clear()
+
+
+# 多个 Profiler 共享 tracemalloc：按引用计数，最后一个关闭时才停止（且只停止由剖析器启动的追踪）
+_tracemalloc_lock = threading.Lock()
+# 追踪内存时串行化 Profiler.record：reset_peak / get_traced_memory 是进程级的
+_tracemalloc_record_lock = threading.Lock()
+_tracemalloc_refs = 0
+_tracemalloc_owned = False
+
+
+def _acquire_tracemalloc():
+    global _tracemalloc_refs, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_refs == 0:
+            _tracemalloc_owned = not tracemalloc.is_tracing()
+            if _tracemalloc_owned:
+                tracemalloc.start()
+        _tracemalloc_refs += 1
+
+
+def _release_tracemalloc():
+    global _tracemalloc_refs, _tracemalloc_owned
+    with _tracemalloc_lock:
+        _tracemalloc_refs -= 1
+        if _tracemalloc_refs == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+class Profiler:
+    """
+    可选的逐层性能剖析器。
+
+    记录每次前向中各子算子（patch 化、位置编码插值、LayerNorm、QKV GEMM、softmax、GELU 等）的
+    耗时、FLOPs 与新分配字节数。分配量基于 tracemalloc（NumPy 数据缓冲区会被追踪），
+    track_memory=True 时若 tracemalloc 尚未启动则由剖析器启动。
+    tracemalloc 的峰值统计是进程级的，因此追踪内存时各线程（包括其他模型实例）的子算子串行执行，
+    多线程并发推理（如 ModelService 的线程池）的吞吐会下降；不在子算子内的分配（如其他线程的预处理）
+    仍可能计入，精确的分配量请在单线程下剖析。
+    最近 max_calls 次前向的明细保存在 calls 中，report() 给出结构化的汇总。
+    """
+
+    def __init__(self, track_memory=True, max_calls=100):
+        self.track_memory = track_memory
+        self.calls = deque(maxlen=max_calls)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tracing = False
+        if track_memory:
+            _acquire_tracemalloc()
+            self._tracing = True
+
+    def close(self):
+        if self._tracing:
+            _release_tracemalloc()
+            self._tracing = False
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def begin_call(self, input_shape):
+        self._local.records = []
+        self._local.layer = None
+        self._local.input_shape = list(input_shape)
+        self._local.start = time.perf_counter()
+
+    def end_call(self):
+        call = {
+            "input_shape": self._local.input_shape,
+            "time_ms": (time.perf_counter() - self._local.start) * 1000,
+            "ops": self._local.records,
+        }
+        self._local.records = None
+        with self._lock:
+            self.calls.append(call)
+
+    def set_layer(self, layer):
+        self._local.layer = layer
+
+    @contextmanager
+    def record(self, op, flops=0):
+        records = getattr(self._local, "records", None)
+        track = self.track_memory and tracemalloc.is_tracing()
+        with _tracemalloc_record_lock if track else nullcontext():
+            if track:
+                start_mem = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+            peak_mem = tracemalloc.get_traced_memory()[1] if track else None
+        if records is not None:
+            records.append({
+                "layer": self._local.layer,
+                "op": op,
+                "time_ms": elapsed * 1000,
+                "flops": int(flops),
+                "bytes_allocated": max(peak_mem - start_mem, 0) if track else None,
+            })
+
+    def report(self):
+        """
+        汇总最近的前向记录：
+          - ops: 按子算子汇总的次数 / 总耗时 / 占比 / FLOPs / GFLOP/s / 新分配字节数（按耗时降序；
+            未追踪内存时新分配字节数为 None；多线程推理时可能包含其他线程在子算子之外的分配）
+          - layers: 每层（embeddings 与 final_norm 记为 None）的总耗时
+          - last_call: 最近一次前向的逐算子明细
+        """
+        with self._lock:
+            calls = list(self.calls)
+        total_ms = sum(call["time_ms"] for call in calls)
+
+        ops = {}
+        layers = {}
+        for call in calls:
+            for rec in call["ops"]:
+                agg = ops.setdefault(rec["op"], {"count": 0, "time_ms": 0.0, "flops": 0, "bytes_allocated": None})
+                agg["count"] += 1
+                agg["time_ms"] += rec["time_ms"]
+                agg["flops"] += rec["flops"]
+                if rec["bytes_allocated"] is not None:
+                    agg["bytes_allocated"] = (agg["bytes_allocated"] or 0) + rec["bytes_allocated"]
+                layers[rec["layer"]] = layers.get(rec["layer"], 0.0) + rec["time_ms"]
+        for agg in ops.values():
+            agg["share"] = agg["time_ms"] / total_ms if total_ms else 0.0
+            agg["gflops_per_s"] = agg["flops"] / agg["time_ms"] / 1e6 if agg["time_ms"] else 0.0
+
+        return {
+            "num_calls": len(calls),
+            "total_time_ms": total_ms,
+            "ops": dict(sorted(ops.items(), key=lambda item: -item[1]["time_ms"])),
+            "layers": [
+                {"layer": layer, "time_ms": ms}
+                for layer, ms in sorted(layers.items(), key=lambda item: (item[0] is not None, item[0] or 0))
+            ],
+            "last_call": calls[-1] if calls else None,
+        }
+
+    def format_report(self):
+        """report() 的文本表格形式"""
+        report = self.report()
+        lines = [
+            f"calls: {report['num_calls']}  total: {report['total_time_ms']:.1f} ms",
+            f"{'op':<16}{'count':>7}{'time_ms':>11}{'share':>8}{'GFLOP/s':>10}{'alloc_MB':>10}",
+        ]
+        for op, agg in report["ops"].items():
+            alloc = "n/a" if agg["bytes_allocated"] is None else f"{agg['bytes_allocated'] / 1024 / 1024:.2f}"
+            lines.append(
+                f"{op:<16}{agg['count']:>7}{agg['time_ms']:>11.2f}{agg['share'] * 100:>7.1f}%"
+                f"{agg['gflops_per_s']:>10.2f}{alloc:>10}"
+            )
+        return "\n".join(lines)
+
+
+def bipartite_soft_matching(metric, r, size=None):
+    """
+    ToMe 二分软匹配：token 交替分为 A / B 两组，A 中每个 token 连向 B 中最相似（余弦）的 token，
+    取相似度最高的 r 条边，把对应的 A token 合并进 B。CLS（第 0 个 token）不参与合并。
+
+    metric: (B, N, C) 相似度度量（各头 key 的均值）
+    size: 可选 (B, N) 每个 token 代表的原始 patch 数；0 表示 padding token，
+          padding token 优先被合并掉，且不会成为合并目标
+    return: merge(x, size) -> (x', size')，(B, N, D) 按 size 加权平均合并为 (B, N - r, D)
+    """
+    B, N, _ = metric.shape
+    r = min(r, (N - 1) // 2)
+    if r <= 0:
+        return None
+
+    metric = metric / np.maximum(np.linalg.norm(metric, axis=-1, keepdims=True), 1e-6)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    scores = a @ b.transpose(0, 2, 1)  # (B, Na, Nb)
+    if size is not None:
+        scores = np.where(size[:, None, 1::2] == 0, -np.inf, scores)
+        scores = np.where(size[:, ::2, None] == 0, np.inf, scores)
+    scores[:, 0, :] = -np.inf  # 保护 CLS
+
+    node_max = scores.max(axis=-1)  # (B, Na)
+    node_idx = scores.argmax(axis=-1)
+    edge_idx = np.argsort(-node_max, axis=-1, kind="stable")
+    src_idx = edge_idx[:, :r]  # 被合并的 A token
+    unm_idx = np.sort(edge_idx[:, r:], axis=-1)  # 保留的 A token，排序后 CLS 仍在第 0 位
+    dst_idx = np.take_along_axis(node_idx, src_idx, axis=-1)  # 合并目标（B 组下标）
+    Nb = b.shape[1]
+    flat_dst = (dst_idx + np.arange(B)[:, None] * Nb).ravel()
+
+    def merge(x, size):
+        D = x.shape[-1]
+        xw = x * size[..., None]
+        xa, xb = xw[:, ::2], np.ascontiguousarray(xw[:, 1::2])
+        sa, sb = size[:, ::2], np.ascontiguousarray(size[:, 1::2])
+
+        src = np.take_along_axis(xa, src_idx[..., None], axis=1)
+        np.add.at(xb.reshape(B * Nb, D), flat_dst, src.reshape(-1, D))
+        np.add.at(sb.reshape(-1), flat_dst, np.take_along_axis(sa, src_idx, axis=1).ravel())
+
+        x = np.concatenate([np.take_along_axis(xa, unm_idx[..., None], axis=1), xb], axis=1)
+        size = np.concatenate([np.take_along_axis(sa, unm_idx, axis=1), sb], axis=1)
+        x /= np.maximum(size, 1e-6)[..., None]  # padding token（size 为 0）保持为 0
+        return x, size
+
+    return merge
+
+
+OUTPUT_KINDS = ("cls", "mean", "gem", "patch")
+
+
+def parse_output_name(name, num_layers):
+    """
+    "{kind}" / "layer{i}.{kind}" -> (layer, kind)，最后一层记为 num_layers - 1。
+    i 可为负数，按 Python 下标解释。
+    """
+    layer, _, kind = name.rpartition(".")
+    if kind not in OUTPUT_KINDS:
+        raise ValueError(f"不支持的输出: {name}，可选: {OUTPUT_KINDS}")
+    if not layer:
+        return num_layers - 1, kind
+    if not layer.startswith("layer"):
+        raise ValueError(f"不支持的输出: {name}，中间层写作 layer{{i}}.{kind}")
+    idx = int(layer[len("layer"):])
+    if not -num_layers <= idx < num_layers:
+        raise ValueError(f"输出 {name} 的层号超出范围 [0, {num_layers})")
+    return idx % num_layers, kind
+
+
+def parse_output_spec(outputs, num_layers):
+    """
+    解析输出规格，返回 {layer: set(kind)}。
+
+    outputs 中每一项为 "{kind}" 或 "layer{i}.{kind}"（见 parse_output_name）：
+      - cls: CLS token (B, D)
+      - mean: patch token 的平均 (B, D)
+      - gem: patch token 的 GeM pooling (B, D)
+      - patch: patch token 网格 (B, h, w, D)（padded batch 时为每张图 (h, w, D) 的 list）
+    中间层的输出与最终输出一样先经过最后的 LayerNorm（同 DINOv2 get_intermediate_layers）。
+    """
+    spec = {}
+    for name in outputs:
+        idx, kind = parse_output_name(name, num_layers)
+        spec.setdefault(idx, set()).add(kind)
+    return spec
+
+
+def profile_op(profiler, op, flops=0):
+    """profiler 为 None（未开启剖析）时返回空上下文"""
+    return nullcontext() if profiler is None else profiler.record(op, flops)
 
 
 class Embeddings:
-    def __init__(self, weights):
+    profiler = None
+
+    def __init__(self, weights, pos_cache_size=32):
         """
         NumPy 实现的 Dinov2 Embeddings 层。
 
@@ -24,43 +718,87 @@ class Embeddings:
           - embeddings.position_embeddings: (1, N+1, D)
           - embeddings.patch_embeddings.projection.weight: (D, C, ps, ps) 或等价形状
           - embeddings.patch_embeddings.projection.bias: (D,)
+
+        pos_cache_size: 插值后位置编码的 LRU 缓存容量（按 patch 网格 (new_h, new_w) 缓存）
         """
-        self.hidden_size = 768  # D
-        self.patch_size = 14    # ps
+        # patch projection weight: (D, C, ps, ps)，D 与 ps 由权重形状决定
+        proj_w = weights["embeddings.patch_embeddings.projection.weight"]
+        self.hidden_size = proj_w.shape[0]  # D
+        self.patch_size = proj_w.shape[-1]  # ps
 
         self.cls_token = weights["embeddings.cls_token"]  # (1, 1, D)
         self.position_embeddings = weights["embeddings.position_embeddings"]  # (1, N+1, D)
 
-        # patch projection weight: (D, C, ps, ps) -> (D, C*ps*ps) -> transpose -> (C*ps*ps, D)
-        proj_w = weights["embeddings.patch_embeddings.projection.weight"]
+        # (D, C, ps, ps) -> (D, C*ps*ps) -> transpose -> (C*ps*ps, D)
         self.patch_embed_w = proj_w.reshape(self.hidden_size, -1).T  # (patch_dim, D)
 
         proj_b = weights["embeddings.patch_embeddings.projection.bias"]
         self.patch_embed_b = proj_b.reshape(self.hidden_size, 1).T   # (1, D)
 
-    def pixel2patches(self, pixel_values):
+        # (new_h, new_w) -> (1, 1+new_h*new_w, D)，多线程推理共享同一个缓存
+        self.pos_cache_size = pos_cache_size
+        self._pos_cache = OrderedDict()
+        self._pos_cache_lock = threading.Lock()
+
+        # 权重文件中自带的预插值位置编码直接放入缓存
+        for key in weights.keys():
+            if key.startswith(POS_GRID_PREFIX):
+                new_h, new_w = (int(n) for n in key[len(POS_GRID_PREFIX):].split("x"))
+                self._pos_cache[(new_h, new_w)] = weights[key]
+
+    def pixel2patches(self, pixel_values, out=None):
+        """
+        (B, C, H, W) -> (B, h*w, C*ps*ps)，patch 向量按 (C, ps, ps) 展开。
+        通过 reshape/transpose 得到 (B, h, w, C, ps, ps) 的零拷贝视图，只做一次连续化拷贝
+        （写入 out，若提供）。
+        """
         B, C, H, W = pixel_values.shape
         ps = self.patch_size
         assert H % ps == 0 and W % ps == 0, f"H,W must be divisible by patch_size={ps}, got {(H, W)}"
+        h, w = H // ps, W // ps
 
-        patches = []
-        for i in range(0, H, ps):
-            for j in range(0, W, ps):
-                patch = pixel_values[:, :, i:i+ps, j:j+ps].reshape(B, -1)  # (B, C*ps*ps)
-                patches.append(patch)
-
-        patches = np.stack(patches, axis=1)  # (B, num_patches, patch_dim)
-        return patches
+        view = pixel_values.reshape(B, C, h, ps, w, ps).transpose(0, 2, 4, 1, 3, 5)  # (B, h, w, C, ps, ps)
+        if out is None:
+            return view.reshape(B, h * w, C * ps * ps)
+        np.copyto(out.reshape(B, h, w, C, ps, ps), view)
+        return out
 
     def interpolate_pos_encoding(self, embeddings, height, width):
         """
         将 self.position_embeddings (训练时固定网格) 插值到当前输入分辨率对应的 patch 网格。
 
         返回形状：(1, 1 + new_num_patches, D)，可广播到 batch 维。
+        结果按 (new_h, new_w) 缓存（只读），重复的网格不再调用 scipy zoom。
+        """
+        ps = self.patch_size
+        key = (height // ps, width // ps)
+
+        with self._pos_cache_lock:
+            cached = self._pos_cache.get(key)
+            if cached is not None:
+                self._pos_cache.move_to_end(key)
+                return cached
+
+        pos_embed = self._interpolate_pos_grid(*key)
+        pos_embed.flags.writeable = False
+
+        with self._pos_cache_lock:
+            self._pos_cache[key] = pos_embed
+            self._pos_cache.move_to_end(key)
+            while len(self._pos_cache) > self.pos_cache_size:
+                self._pos_cache.popitem(last=False)
+        return pos_embed
+
+    def precompute_pos_encoding(self, grids):
+        """
+        预先插值并缓存给定 patch 网格 [(new_h, new_w), ...] 的位置编码，
+        一般在模型加载时对 common_patch_grids() 调用，避免首个请求承担 scipy 开销。
         """
         ps = self.patch_size
-        new_h = height // ps
-        new_w = width // ps
+        for new_h, new_w in grids:
+            self.interpolate_pos_encoding(None, new_h * ps, new_w * ps)
+
+    def _interpolate_pos_grid(self, new_h, new_w):
         new_num_patches = new_h * new_w
 
         pos = self.position_embeddings  # (1, 1+old_num_patches, D)
@@ -69,7 +807,7 @@ class Embeddings:
 
         # 如果 patch 数完全一致，直接返回
         if old_num_patches == new_num_patches:
-            return pos
+            return pos.copy()
 
         # 分离 cls 与 patch 位置编码
         cls_pos = pos[:, :1, :]         # (1, 1, D)
@@ -103,33 +841,107 @@ class Embeddings:
         # 拼回 cls + patch
         return np.concatenate([cls_pos, patch_pos_resized], axis=1)  # (1, 1+new_num_patches, D)
 
-    def __call__(self, pixel_values):
-        B, _, H, W = pixel_values.shape
-
-        patch_values = self.pixel2patches(pixel_values)  # (B, h*w, C*ps*ps)
-
-        # (B, h*w, patch_dim) @ (patch_dim, D) + (1, D) -> (B, h*w, D)
-        embeddings = patch_values @ self.patch_embed_w + self.patch_embed_b
-
-        cls_token = np.tile(self.cls_token, (B, 1, 1))  # (B, 1, D)
-        embeddings = np.concatenate([cls_token, embeddings], axis=1)  # (B, 1+h*w, D)
-
-        pos_embed = self.interpolate_pos_encoding(embeddings, H, W)  # (1, 1+h*w, D) or same length
-        embeddings = embeddings + pos_embed  # broadcast on batch
+    def __call__(self, pixel_values, workspace=None):
+        """
+        workspace: 可选的 Workspace，提供时 patch 与 embeddings 写入其中的复用缓冲区
+        （返回的 embeddings 即为 workspace 中的 "embeddings" 缓冲区，下一次前向会被覆盖）
+        """
+        B, C, H, W = pixel_values.shape
+        ps, D = self.patch_size, self.hidden_size
+        num_patches = (H // ps) * (W // ps)
+
+        def buffer(name, shape):
+            return None if workspace is None else workspace.get(name, shape, pixel_values.dtype)
+
+        with profile_op(self.profiler, "patchify"):
+            patch_values = self.pixel2patches(pixel_values, out=buffer("patches", (B, num_patches, C * ps * ps)))
+
+        # CLS 与 patch 投影直接写入 (B, 1+h*w, D) 的输出，不再 tile / concatenate
+        embeddings = buffer("embeddings", (B, 1 + num_patches, D))
+        if embeddings is None:
+            embeddings = np.empty((B, 1 + num_patches, D), dtype=pixel_values.dtype)
+        with profile_op(self.profiler, "patch_embed", 2 * patch_values.size * D):
+            # (B, h*w, patch_dim) @ (patch_dim, D) + (1, D) -> (B, h*w, D)
+            np.matmul(patch_values, self.patch_embed_w, out=embeddings[:, 1:])
+            embeddings[:, 1:] += self.patch_embed_b
+            embeddings[:, 0] = self.cls_token[0]
+
+        with profile_op(self.profiler, "pos_interp"):
+            pos_embed = self.interpolate_pos_encoding(embeddings, H, W)  # (1, 1+h*w, D) or same length
+        with profile_op(self.profiler, "pos_add", embeddings.size):
+            embeddings += pos_embed  # broadcast on batch
         return embeddings
 
+    def embed_padded(self, pixel_list, workspace=None):
+        """
+        变分辨率批处理：每张图像独立 patch 化并叠加各自插值后的位置编码，
+        再在 token 维度上右侧补零，对齐到 batch 内最长的序列。
+
+        pixel_list: 若干 (C, H, W) 或 (1, C, H, W) 数组，H/W 可以各不相同
+        workspace: 可选的 Workspace，patch / 投影 / embeddings 写入其中的复用缓冲区
+        返回 (embeddings, mask)：
+          - embeddings: (B, 1+max_num_patches, D)
+          - mask: (B, 1+max_num_patches) bool，True 表示有效 token
+        """
+        pixel_list = [p if p.ndim == 4 else p[None] for p in pixel_list]
+        ps, D = self.patch_size, self.hidden_size
+        dtype = pixel_list[0].dtype
+        lengths = [1 + (p.shape[2] // ps) * (p.shape[3] // ps) for p in pixel_list]
+        B, N = len(pixel_list), max(lengths)
+        total, patch_dim = sum(lengths) - B, pixel_list[0].shape[1] * ps * ps
+
+        def buffer(name, shape):
+            return np.empty(shape, dtype=dtype) if workspace is None else workspace.get(name, shape, dtype)
+
+        # 所有图像的 patch 直接写入同一个 (total, patch_dim) 缓冲区，做一次大 GEMM
+        with profile_op(self.profiler, "patchify"):
+            patches = buffer("patches", (total, patch_dim))
+            offset = 0
+            for p, length in zip(pixel_list, lengths):
+                self.pixel2patches(p, out=patches[offset:offset + length - 1].reshape(1, length - 1, patch_dim))
+                offset += length - 1
+
+        with profile_op(self.profiler, "patch_embed", 2 * patches.size * D):
+            projected = np.matmul(patches, self.patch_embed_w, out=buffer("patch_proj", (total, D)))
+            projected += self.patch_embed_b
+
+        embeddings = buffer("embeddings", (B, N, D))
+        mask = np.zeros((B, N), dtype=bool)
+        offset = 0
+        for i, (pixel_values, length) in enumerate(zip(pixel_list, lengths)):
+            _, _, H, W = pixel_values.shape
+            with profile_op(self.profiler, "pos_interp"):
+                pos_embed = self.interpolate_pos_encoding(None, H, W)[0]  # (length, D)
+            embeddings[i, 0] = self.cls_token[0, 0]
+            embeddings[i, 1:length] = projected[offset:offset + length - 1]
+            embeddings[i, :length] += pos_embed
+            embeddings[i, length:] = 0
+            mask[i, :length] = True
+            offset += length - 1
+        return embeddings, mask
+
 
 class LayerNorm:
+    kernels = None
+
     def __init__(self, weight, bias, eps=1e-6):
         self.weight = weight
         self.bias = bias
         self.eps = eps
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
+        if self.kernels is not None:
+            return self.kernels.layer_norm(x, self.weight, self.bias, self.eps, out=out)
+        # out: 可选的输出缓冲区（不能与 x 相同）；除 (..., 1) 的统计量外不再分配临时数组
         mean = x.mean(-1, keepdims=True)
-        var = x.var(-1, keepdims=True)
-        norm = (x - mean) / np.sqrt(var + self.eps)
-        return norm * self.weight + self.bias
+        out = np.subtract(x, mean, out=out)
+        var = np.einsum("...i,...i->...", out, out)[..., None]
+        var /= x.shape[-1]
+        var += self.eps
+        out /= np.sqrt(var, out=var)
+        out *= self.weight
+        out += self.bias
+        return out
 
 
 class LayerScale:
@@ -140,14 +952,140 @@ class LayerScale:
         return x * self.lambda1
 
 
+_upcast_local = threading.local()
+
+
+def upcast_matmul(x, weight, out=None, block_size=1024):
+    """
+    x @ weight，weight 为低精度存储的 (in, out)（float16 / int8）：按输出列分块上转为 x.dtype 再做 GEMM，
+    累加在计算精度中进行。上转写入每个线程复用的 scratch 缓冲区（最大 (in, block_size)），
+    前向不再为整个权重矩阵分配上转副本。
+    """
+    in_features, out_features = weight.shape
+    if out is None:
+        out = np.empty(x.shape[:-1] + (out_features,), dtype=x.dtype)
+    size = in_features * min(block_size, out_features)
+    scratch = getattr(_upcast_local, "scratch", None)
+    if scratch is None or scratch.size < size or scratch.dtype != x.dtype:
+        scratch = _upcast_local.scratch = np.empty(size, dtype=x.dtype)
+    for j in range(0, out_features, block_size):
+        w_blk = weight[:, j:j + block_size]
+        buf = scratch[:w_blk.size].reshape(w_blk.shape)
+        np.copyto(buf, w_blk, casting="unsafe")
+        np.matmul(x, buf, out=out[..., j:j + block_size])
+    return out
+
+
 class Linear:
-    def __init__(self, weight, bias):
-        self.weight = weight
+    def __init__(self, weight, bias, weight_dtype=None):
+        # 传入 weight: (out_features, in_features)（与权重文件一致），
+        # 加载时一次性转置为连续的 (in_features, out_features)，前向不再做 .T
+        # weight_dtype: 可选的权重存储精度（如 float16），为 None 时保持原精度。
+        # 低精度存储只节省常驻内存：前向逐块上转（upcast_matmul）有额外开销，吞吐通常低于直接用 dtype 存储
+        self.weight = np.ascontiguousarray(weight.T, dtype=weight_dtype)
         self.bias = bias
 
-    def __call__(self, x):
-        # x: (..., in_features), weight: (out_features, in_features)
-        return x @ self.weight.T + self.bias
+    @classmethod
+    def from_prepared(cls, weight, bias):
+        """直接使用已是 (in, out) 布局的权重（如 mmap 权重文件中的视图），不做任何拷贝"""
+        linear = cls.__new__(cls)
+        linear.weight = weight
+        linear.bias = bias
+        return linear
+
+    def prepared_state(self, name):
+        return {f"{name}.prepared.weight": self.weight, f"{name}.prepared.bias": self.bias}
+
+    def __call__(self, x, out=None):
+        # x: (..., in_features), weight: (in_features, out_features)
+        if self.weight.dtype != x.dtype:
+            out = upcast_matmul(x, self.weight, out)
+        else:
+            out = np.matmul(x, self.weight, out=out)
+        out += self.bias
+        return out
+
+
+class QuantizedLinear:
+    def __init__(self, qweight, scale, bias, block_size=1024):
+        """
+        int8 weight-only 量化的 Linear。
+
+        qweight: (out_features, in_features) int8，加载时转置为连续的 (in, out)
+        scale: (out_features,) 每个输出通道的反量化系数
+        前向按输出列分块把 int8 权重上转为计算精度再做 GEMM（dequantize-on-the-fly，见 upcast_matmul），
+        只物化 (in, block_size) 的复用缓冲区；per-channel scale 在 GEMM 之后乘到输出上。
+        """
+        self.qweight = np.ascontiguousarray(qweight.T)
+        self.scale = scale
+        self.bias = bias
+        self.block_size = block_size
+
+    @classmethod
+    def from_prepared(cls, qweight, scale, bias, block_size=1024):
+        """qweight 已是 (in, out) 布局（如 mmap 权重文件中的视图），不做任何拷贝"""
+        linear = cls.__new__(cls)
+        linear.qweight = qweight
+        linear.scale = scale
+        linear.bias = bias
+        linear.block_size = block_size
+        return linear
+
+    def prepared_state(self, name):
+        return {
+            f"{name}.prepared.qweight": self.qweight,
+            f"{name}.prepared.scale": self.scale,
+            f"{name}.prepared.bias": self.bias,
+        }
+
+    def __call__(self, x, out=None):
+        out = upcast_matmul(x, self.qweight, out, self.block_size)
+        out *= self.scale.astype(x.dtype, copy=False)
+        out += self.bias
+        return out
+
+
+def build_linear(weights, name, keys, row_scales=None, weight_dtype=None, qweights=None):
+    """
+    按权重准备策略构建 Linear / QuantizedLinear。
+
+    name: 准备后权重的 key 前缀；weights 中已有 f"{name}.prepared.*"（mmap 权重文件）时直接使用
+    keys: 一个或多个原始 Linear 的 key 前缀（读取 .weight / .bias），沿输出维拼接（用于 QKV 融合）
+    row_scales: 与 keys 对应的输出通道缩放（标量、(out,) 向量或 None），同时作用于权重和偏置，
+                用于折叠注意力缩放与 LayerScale；对 per-channel int8 量化只需缩放 scale
+    qweights: quantize_weights() 的结果，提供时构建 QuantizedLinear
+    """
+    if f"{name}.prepared.bias" in weights:
+        if f"{name}.prepared.qweight" in weights:
+            linear = QuantizedLinear.from_prepared(
+                weights[f"{name}.prepared.qweight"],
+                weights[f"{name}.prepared.scale"],
+                weights[f"{name}.prepared.bias"],
+            )
+        else:
+            linear = Linear.from_prepared(weights[f"{name}.prepared.weight"], weights[f"{name}.prepared.bias"])
+        linear.name = name
+        return linear
+
+    row_scales = row_scales or [None] * len(keys)
+
+    def scale_rows(w, r):
+        if r is None:
+            return w
+        return w * r if np.ndim(r) == 0 else w * np.reshape(r, (-1,) + (1,) * (w.ndim - 1))
+
+    bias = np.concatenate([scale_rows(weights[f"{k}.bias"], r) for k, r in zip(keys, row_scales)])
+    if qweights is not None:
+        qweight = np.concatenate([qweights[f"{k}.weight"] for k in keys], axis=0)
+        scale = np.concatenate([
+            scale_rows(qweights[f"{k}.weight.scale"], r) for k, r in zip(keys, row_scales)
+        ])
+        linear = QuantizedLinear(qweight, scale, bias)
+    else:
+        weight = np.concatenate([scale_rows(weights[f"{k}.weight"], r) for k, r in zip(keys, row_scales)], axis=0)
+        linear = Linear(weight, bias, weight_dtype)
+    linear.name = name
+    return linear
 
 
 class SingleHeadAttention:
@@ -180,106 +1118,446 @@ class SingleHeadAttention:
 
 
 class MultiHeadAttention:
-    def __init__(self, config, prefix, weights):
+    profiler = None
+    kernels = None
+
+    def __init__(self, config, prefix, weights, layer_scale=None, qweights=None):
+        """
+        加载时的权重准备：
+          - Q/K/V 融合为一个 (D, 3D) 的投影，一次 GEMM 得到 qkv
+          - 1/sqrt(head_dim) 缩放折叠进 query 的权重与偏置
+          - layer_scale（可选，(D,)）折叠进输出投影，前向无需再乘 LayerScale
+          - qweights（可选）：使用 int8 量化权重构建 QuantizedLinear
+        """
         self.hidden_size = config["hidden_size"]
         self.num_heads = config["num_heads"]
         assert self.hidden_size % self.num_heads == 0, "hidden_size must be divisible by num_heads"
         self.head_dim = self.hidden_size // self.num_heads
+        weight_dtype = config.get("weight_dtype")
+
+        # 注意力实现："full" 物化完整 (B, H, N, N) 分数；"tiled" 分块 online softmax；
+        # "auto" 在 token 数超过 attention_tile_threshold 时使用 tiled
+        self.attention_mode = config.get("attention", "auto")
+        self.attention_block_size = config.get("attention_block_size", 256)
+        self.attention_tile_threshold = config.get("attention_tile_threshold", 1024)
+
+        scale = 1.0 / math.sqrt(self.head_dim)
+        self.qkv_proj = build_linear(
+            weights,
+            f"{prefix}.attention.qkv",
+            [f"{prefix}.attention.{name}" for name in ("query", "key", "value")],
+            row_scales=[scale, None, None],
+            weight_dtype=weight_dtype,
+            qweights=qweights,
+        )
+        self.out_proj = build_linear(
+            weights, f"{prefix}.output.dense", [f"{prefix}.output.dense"],
+            row_scales=[layer_scale], weight_dtype=weight_dtype, qweights=qweights,
+        )
 
-        q_w = weights[f"{prefix}.attention.query.weight"]
-        q_b = weights[f"{prefix}.attention.query.bias"]
-        k_w = weights[f"{prefix}.attention.key.weight"]
-        k_b = weights[f"{prefix}.attention.key.bias"]
-        v_w = weights[f"{prefix}.attention.value.weight"]
-        v_b = weights[f"{prefix}.attention.value.bias"]
-        o_w = weights[f"{prefix}.output.dense.weight"]
-        o_b = weights[f"{prefix}.output.dense.bias"]
-
-        self.q_proj = Linear(q_w, q_b)
-        self.k_proj = Linear(k_w, k_b)
-        self.v_proj = Linear(v_w, v_b)
-        self.out_proj = Linear(o_w, o_b)
+    def use_tiled(self, num_tokens):
+        if self.attention_mode == "tiled":
+            return True
+        if self.attention_mode == "auto":
+            return num_tokens > self.attention_tile_threshold
+        return False
 
-    def __call__(self, x):
+    def __call__(self, x, mask=None, workspace=None, size=None, return_metric=False):
         """
         x: (B, N, D)
-        return: (B, N, D)
+        mask: 可选 (B, N) bool key padding mask，False 的位置（补齐 token）不被注意
+        workspace: 可选的 Workspace，提供时所有中间结果写入其中的复用缓冲区
+        size: 可选 (B, N) token 大小（token merging），按 log(size) 做 proportional attention，
+              size 为 0 的 token 等价于被 mask；提供时忽略 mask
+        return: (B, N, D)（使用 workspace 时为其中的缓冲区，下一次调用会被覆盖）；
+                return_metric 为 True 时额外返回 token merging 的相似度度量 (B, N, d)（各头 key 的均值）
         """
         B, N, D = x.shape
         H = self.num_heads
         d = self.head_dim
 
-        q = self.q_proj(x)  # (B, N, D)
-        k = self.k_proj(x)  # (B, N, D)
-        v = self.v_proj(x)  # (B, N, D)
-
-        # (B, N, D) -> (B, H, N, d)
-        q = q.reshape(B, N, H, d).transpose(0, 2, 1, 3)
-        k = k.reshape(B, N, H, d).transpose(0, 2, 1, 3)
-        v = v.reshape(B, N, H, d).transpose(0, 2, 1, 3)
-
-        # attention: (B, H, N, N)
-        att = np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(d)
-        att = softmax(att, axis=-1)
-
-        # out: (B, H, N, d)
-        out = np.matmul(att, v)
+        def buffer(name, shape):
+            return None if workspace is None else workspace.get(name, shape, x.dtype)
+
+        prof = self.profiler
+
+        with profile_op(prof, "qkv_gemm", 2 * x.size * 3 * D):
+            qkv = self.qkv_proj(x, out=buffer("qkv", (B, N, 3 * D)))  # (B, N, 3D)
+
+        # (B, N, 3D) -> (3, B, H, N, d)，只做一次连续化拷贝
+        with profile_op(prof, "head_split"):
+            qkv_heads = buffer("qkv_heads", (3, B, H, N, d))
+            if qkv_heads is None:
+                qkv_heads = np.ascontiguousarray(qkv.reshape(B, N, 3, H, d).transpose(2, 0, 3, 1, 4))
+            else:
+                np.copyto(qkv_heads, qkv.reshape(B, N, 3, H, d).transpose(2, 0, 3, 1, 4))
+            q, k, v = qkv_heads[0], qkv_heads[1], qkv_heads[2]
+
+        metric = k.mean(axis=1) if return_metric else None
+
+        bias = None
+        if size is not None:
+            with np.errstate(divide="ignore"):
+                bias = np.log(size).astype(q.dtype)[:, None, None, :]
+        elif mask is not None:
+            # CLS 始终有效，因此每一行至少有一个有限值，softmax 不会出现 NaN
+            bias = np.where(mask, 0.0, -np.inf).astype(q.dtype)[:, None, None, :]
+
+        if self.use_tiled(N):
+            # out: (B, H, N, d)，峰值内存随 block_size 而非 N² 增长
+            with profile_op(prof, "attn_tiled", 4 * B * H * N * N * d + 5 * B * H * N * N):
+                out = tiled_attention(
+                    q, k, v, bias, self.attention_block_size, out=buffer("ctx_heads", (B, H, N, d))
+                )
+        else:
+            # attention: (B, H, N, N)，缩放已折叠进 q
+            with profile_op(prof, "attn_scores", 2 * B * H * N * N * d):
+                att = np.matmul(q, k.transpose(0, 1, 3, 2), out=buffer("att", (B, H, N, N)))
+                if bias is not None:
+                    att += bias
+            with profile_op(prof, "softmax", 5 * att.size):
+                if self.kernels is not None:
+                    att = self.kernels.softmax(att, out=att)
+                else:
+                    att = softmax(att, axis=-1, out=att)
+
+            # out: (B, H, N, d)
+            with profile_op(prof, "attn_context", 2 * B * H * N * N * d):
+                out = np.matmul(att, v, out=buffer("ctx_heads", (B, H, N, d)))
 
         # (B, H, N, d) -> (B, N, D)
-        out = out.transpose(0, 2, 1, 3).reshape(B, N, D)
+        with profile_op(prof, "head_merge"):
+            ctx = buffer("ctx", (B, N, D))
+            if ctx is None:
+                ctx = out.transpose(0, 2, 1, 3).reshape(B, N, D)
+            else:
+                np.copyto(ctx.reshape(B, N, H, d), out.transpose(0, 2, 1, 3))
 
-        return self.out_proj(out)
+        with profile_op(prof, "out_proj", 2 * x.size * D):
+            out = self.out_proj(ctx, out=buffer("proj", (B, N, D)))
+        return (out, metric) if return_metric else out
 
 
 class MLP:
-    def __init__(self, prefix, weights):
-        w1 = weights[f"{prefix}.mlp.fc1.weight"]
-        b1 = weights[f"{prefix}.mlp.fc1.bias"]
-        w2 = weights[f"{prefix}.mlp.fc2.weight"]
-        b2 = weights[f"{prefix}.mlp.fc2.bias"]
+    profiler = None
+    kernels = None
+
+    def __init__(self, prefix, weights, layer_scale=None, weight_dtype=None, qweights=None):
+        # layer_scale（可选）折叠进 fc2
+        self.fc1 = build_linear(
+            weights, f"{prefix}.mlp.fc1", [f"{prefix}.mlp.fc1"],
+            weight_dtype=weight_dtype, qweights=qweights,
+        )
+        self.fc2 = build_linear(
+            weights, f"{prefix}.mlp.fc2", [f"{prefix}.mlp.fc2"],
+            row_scales=[layer_scale], weight_dtype=weight_dtype, qweights=qweights,
+        )
+        self.fc1_out_features = self.fc1.bias.shape[-1]
 
-        self.fc1 = Linear(w1, b1)
-        self.fc2 = Linear(w2, b2)
+    def __call__(self, x, workspace=None):
+        B, N, D = x.shape
+        hidden = self.fc1_out_features
+        prof = self.profiler
 
-    def __call__(self, x):
-        return self.fc2(gelu(self.fc1(x)))
+        def buffer(name, shape):
+            return None if workspace is None else workspace.get(name, shape, x.dtype)
+
+        with profile_op(prof, "fc1", 2 * x.size * hidden):
+            h = self.fc1(x, out=buffer("hidden", (B, N, hidden)))
+        with profile_op(prof, "gelu", 10 * h.size):
+            if self.kernels is not None:
+                h = self.kernels.gelu(h, out=h)
+            else:
+                h = gelu(h, out=h, scratch=buffer("hidden_tmp", h.shape))
+        with profile_op(prof, "fc2", 2 * h.size * D):
+            return self.fc2(h, out=buffer("proj", (B, N, D)))
 
 
 class TransformerBlock:
-    def __init__(self, config, idx, weights):
+    profiler = None
+
+    def __init__(self, config, idx, weights, qweights=None):
         prefix = f"encoder.layer.{idx}"
+        self.idx = idx
+        # token merging：每层在注意力与 MLP 之间合并的 token 数（0 表示不合并）
+        merge_r = config.get("token_merge_r", 0)
+        self.merge_r = merge_r[idx] if isinstance(merge_r, (list, tuple)) else merge_r
 
+        # LayerScale 在加载时折叠进 attention 输出投影与 fc2
         self.norm1 = LayerNorm(weights[f"{prefix}.norm1.weight"], weights[f"{prefix}.norm1.bias"])
-        self.scale1 = LayerScale(weights[f"{prefix}.layer_scale1.lambda1"])
-        self.attn = MultiHeadAttention(config, f"{prefix}.attention", weights)
+        self.attn = MultiHeadAttention(
+            config, f"{prefix}.attention", weights,
+            layer_scale=weights[f"{prefix}.layer_scale1.lambda1"],
+            qweights=qweights
+        )
 
         self.norm2 = LayerNorm(weights[f"{prefix}.norm2.weight"], weights[f"{prefix}.norm2.bias"])
-        self.scale2 = LayerScale(weights[f"{prefix}.layer_scale2.lambda1"])
-        self.mlp = MLP(f"{prefix}", weights)
+        self.mlp = MLP(
+            f"{prefix}", weights,
+            layer_scale=weights[f"{prefix}.layer_scale2.lambda1"],
+            weight_dtype=config.get("weight_dtype"),
+            qweights=qweights
+        )
 
-    def __call__(self, x):
-        x = x + self.scale1(self.attn(self.norm1(x)))
-        x = x + self.scale2(self.mlp(self.norm2(x)))
-        return x
+    def __call__(self, x, mask=None, workspace=None, size=None):
+        """
+        size: 可选 (B, N) token 大小。提供时启用 token merging（ToMe）：注意力按 size 加权，
+              注意力之后合并 merge_r 个最相似的 token，返回 (x, size)；否则只返回 x
+        """
+        # workspace 模式：残差流 x 原地更新，LayerNorm / 投影 / GELU / softmax 写入复用缓冲区
+        prof = self.profiler
+        if prof is not None:
+            prof.set_layer(self.idx)
+
+        def norm_out():
+            return None if workspace is None else workspace.get("norm", x.shape, x.dtype)
+
+        with profile_op(prof, "layernorm", 8 * x.size):
+            h = self.norm1(x, out=norm_out())
+        merging = size is not None and self.merge_r > 0
+        a = self.attn(h, mask, workspace, size=size, return_metric=merging)
+        if merging:
+            a, metric = a
+        with profile_op(prof, "residual", x.size):
+            x = x + a if workspace is None else np.add(x, a, out=x)
+
+        if merging:
+            with profile_op(prof, "token_merge"):
+                merge = bipartite_soft_matching(metric, self.merge_r, size)
+                if merge is not None:
+                    x, size = merge(x, size)
+
+        with profile_op(prof, "layernorm", 8 * x.size):
+            h = self.norm2(x, out=norm_out())
+        m = self.mlp(h, workspace)
+        with profile_op(prof, "residual", x.size):
+            x = x + m if workspace is None else np.add(x, m, out=x)
+        return x if size is None else (x, size)
 
 
 class Dinov2Numpy:
-    def __init__(self, weights, config=None):
+    def __init__(self, weights, config=None, pos_grids=None, dtype="float32", weight_dtype=None,
+                 qweights=None, attention="auto", attention_block_size=256, attention_tile_threshold=1024,
+                 workspace_max_mb=None, token_merge_r=0, fused_kernels=False, num_threads=None):
+        """
+        config: 模型结构 {hidden_size, num_heads, num_layers, patch_size}，默认由 infer_config 从权重推断
+        pos_grids: 可选的 patch 网格列表 [(h, w), ...]，加载时预计算对应的插值位置编码，
+                   例如 common_patch_grids(target_size, patch_size)
+        dtype: 计算精度，默认 float32；权重与输入都会转换到该精度
+        weight_dtype: 可选的 Linear 权重存储精度（如 "float16"），前向时分块上转到 dtype 再计算；
+                      只节省权重常驻内存，吞吐通常低于直接按 dtype 存储
+        qweights: 可选的 int8 量化权重（quantize_weights / load_int8_weights 的结果），
+                  提供时所有 Linear 使用 per-channel int8 权重，优先于 weight_dtype
+        attention: "full" / "tiled" / "auto"；tiled 为分块 online softmax 注意力，
+                   auto 在 token 数超过 attention_tile_threshold 时启用（如 target_size >= 448）
+        attention_block_size: tiled 注意力的 query/key 块大小
+        workspace_max_mb: 每个线程复用的激活缓冲区上限（MB），超过时前向结束后释放；
+                          None 表示不设上限，0 表示不复用（每层重新分配）
+        token_merge_r: token merging（ToMe）每层合并的 token 数（int，或每层一个值的 list），
+                       0 表示关闭；越大越快、CLS 特征与原模型偏差越大
+        fused_kernels: 为 True 时 GELU / softmax / LayerNorm 使用 FusedKernels 的分块融合实现
+        num_threads: FusedKernels 的线程数
+        """
         self.weights = weights
-        self.config = config or {
-            "hidden_size": 768,
-            "num_heads": 12,
-            "num_layers": 12,
-            "patch_size": 14,
+        # 未显式给出 config 时从权重形状推断（ViT-S/B/L/g 均可直接加载）
+        self.config = dict(config or infer_config(weights))
+        self.dtype = np.dtype(dtype)
+        self.config["weight_dtype"] = np.dtype(weight_dtype) if weight_dtype else None
+        self.config["attention"] = attention
+        self.config["attention_block_size"] = attention_block_size
+        self.config["attention_tile_threshold"] = attention_tile_threshold
+        self.config["token_merge_r"] = token_merge_r
+        self.config["fused_kernels"] = fused_kernels
+
+        # 精度策略：所有权重先统一到计算精度，避免 float32/float64 混算导致的隐式提升
+        # 已量化的 Linear 权重不再读取浮点版本；准备后的权重（mmap 文件）原样使用
+        weights = {
+            k: weights[k] if ".prepared." in k else np.asarray(weights[k], dtype=self.dtype)
+            for k in weights.keys()
+            if qweights is None or k not in qweights
         }
 
         self.embeddings = Embeddings(weights)
-        self.blocks = [TransformerBlock(self.config, i, weights) for i in range(self.config["num_layers"])]
+        if pos_grids:
+            self.embeddings.precompute_pos_encoding(pos_grids)
+        self.blocks = [
+            TransformerBlock(self.config, i, weights, qweights) for i in range(self.config["num_layers"])
+        ]
         self.norm = LayerNorm(weights["layernorm.weight"], weights["layernorm.bias"])
+        self.workspaces = None
+        if workspace_max_mb is None or workspace_max_mb > 0:
+            self.workspaces = WorkspaceCache(None if workspace_max_mb is None else int(workspace_max_mb * 1024 * 1024))
+        self.profiler = None
+
+        self.kernels = FusedKernels(num_threads) if fused_kernels else None
+        if self.kernels is not None:
+            self.norm.kernels = self.kernels
+            for blk in self.blocks:
+                blk.norm1.kernels = blk.norm2.kernels = blk.attn.kernels = blk.mlp.kernels = self.kernels
+
+    def enable_profiling(self, profiler=None):
+        """开启逐层剖析（默认新建 Profiler），返回使用的 Profiler"""
+        self.disable_profiling()
+        self.profiler = profiler or Profiler()
+        self._set_profiler(self.profiler)
+        return self.profiler
+
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.close()
+        self.profiler = None
+        self._set_profiler(None)
+
+    def _set_profiler(self, profiler):
+        self.embeddings.profiler = profiler
+        for blk in self.blocks:
+            blk.profiler = blk.attn.profiler = blk.mlp.profiler = profiler
+
+    def export_prepared_weights(self):
+        """
+        导出加载时准备好的权重：融合/转置/折叠（及量化）后的 Linear、转换到计算精度的其余权重、
+        以及已缓存的插值位置编码。结果交给 save_mmap_weights 写盘后，加载时无需任何拷贝或计算。
+        """
+        prepared = {}
+        for key in self.weights.keys():
+            if ".prepared." in key or key.rsplit(".", 1)[0].endswith(LINEAR_SUFFIXES):
+                continue
+            prepared[key] = np.asarray(self.weights[key], dtype=self.dtype)
 
-    def __call__(self, pixel_values):
-        x = self.embeddings(pixel_values)  # (B, 1+num_patches, D)
         for blk in self.blocks:
-            x = blk(x)
-        x = self.norm(x)
-        return x[:, 0]  # CLS: (B, D)
+            for linear in (blk.attn.qkv_proj, blk.attn.out_proj, blk.mlp.fc1, blk.mlp.fc2):
+                prepared.update(linear.prepared_state(linear.name))
+
+        with self.embeddings._pos_cache_lock:
+            for (new_h, new_w), pos_embed in self.embeddings._pos_cache.items():
+                prepared[f"{POS_GRID_PREFIX}{new_h}x{new_w}"] = pos_embed
+        return prepared
+
+    def __call__(self, pixel_values, outputs=None, gem_p=3.0):
+        """
+        pixel_values:
+          - (B, C, H, W) 数组：常规前向，batch 内分辨率一致
+          - list/tuple of (C, H, W) 或 (1, C, H, W)：分辨率可不同，走 padded batch 模式，
+            每张图的 CLS 特征与单独推理一致（开启 token merging 时改为按分辨率分组堆叠前向，
+            否则补齐 token 会占用每层的合并数，结果随同批的其他图像变化）
+        outputs: 可选的输出规格（见 parse_output_spec），如 ["cls", "gem", "layer8.mean", "patch"]；
+                 为 None 时只返回 CLS (B, D)，否则一次前向返回 {name: 结果} 字典。
+                 中间层只在经过时计算并保留所要求的结果
+        gem_p: GeM pooling 的指数
+        """
+        prof = self.profiler
+        padded = isinstance(pixel_values, (list, tuple))
+        merging = any(blk.merge_r > 0 for blk in self.blocks)
+        if padded and merging:
+            return self._call_grouped(pixel_values, outputs, gem_p)
+        if padded:
+            pixel_values = [np.asarray(p, dtype=self.dtype) for p in pixel_values]
+            if prof is not None:
+                prof.begin_call([len(pixel_values)] + [list(p.shape[-2:]) for p in pixel_values])
+            shapes = [p.shape[-2:] for p in pixel_values]
+        else:
+            pixel_values = np.asarray(pixel_values, dtype=self.dtype)
+            if prof is not None:
+                prof.begin_call(pixel_values.shape)
+            shapes = [pixel_values.shape[-2:]]
+        ps = self.embeddings.patch_size
+        grids = [(H // ps, W // ps) for H, W in shapes]
+
+        # 残差流从 workspace 中的 embeddings 缓冲区开始，各层在其上原地更新
+        workspace = None if self.workspaces is None else self.workspaces.get()
+        if padded:
+            x, mask = self.embeddings.embed_padded(pixel_values, workspace)
+        else:
+            x, mask = self.embeddings(pixel_values, workspace), None  # (B, 1+num_patches, D)
+
+        spec = None if outputs is None else parse_output_spec(outputs, len(self.blocks))
+        if merging and spec and any("patch" in kinds for kinds in spec.values()):
+            raise ValueError("token merging 开启时无法输出 patch 网格")
+        results = {}
+
+        # token merging：记录每个 token 代表的原始 patch 数（merging 时不会走 padded 模式）
+        size = None
+        if merging:
+            size = np.ones(x.shape[:2], dtype=x.dtype)
+        for idx, blk in enumerate(self.blocks):
+            if merging:
+                x, size = blk(x, None, workspace, size)
+            else:
+                x = blk(x, mask, workspace)
+            if spec and idx in spec and idx != len(self.blocks) - 1:
+                pooled = self._pool_outputs(x, spec[idx], size if merging else mask, grids, padded, gem_p)
+                results[idx] = pooled
+
+        if prof is not None:
+            prof.set_layer(None)
+        if spec is None:
+            with profile_op(prof, "final_norm", 8 * x.size):
+                x = self.norm(x)
+            if prof is not None:
+                prof.end_call()
+            if self.workspaces is not None:
+                self.workspaces.release()
+            return x[:, 0]  # CLS: (B, D)
+
+        last = len(self.blocks) - 1
+        if last in spec:
+            with profile_op(prof, "final_norm", 8 * x.size):
+                results[last] = self._pool_outputs(x, spec[last], size if merging else mask, grids, padded, gem_p)
+        if prof is not None:
+            prof.end_call()
+        if self.workspaces is not None:
+            self.workspaces.release()
+        outputs_by_name = {}
+        for name in outputs:
+            idx, kind = parse_output_name(name, len(self.blocks))
+            outputs_by_name[name] = results[idx][kind]
+        return outputs_by_name
+
+    def _call_grouped(self, pixel_list, outputs, gem_p):
+        """同分辨率的图像堆叠成 (b, C, H, W) 分组前向，结果按输入顺序拼回"""
+        pixel_list = [np.asarray(p if p.ndim == 4 else p[None], dtype=self.dtype) for p in pixel_list]
+        groups = {}
+        for i, p in enumerate(pixel_list):
+            groups.setdefault(p.shape[1:], []).append(i)
+        results = None
+        for indices in groups.values():
+            out = self(np.concatenate([pixel_list[i] for i in indices], axis=0), outputs, gem_p)
+            out = {None: out} if outputs is None else out
+            if results is None:
+                results = {
+                    name: np.empty((len(pixel_list),) + value.shape[1:], dtype=value.dtype)
+                    for name, value in out.items()
+                }
+            for name, value in out.items():
+                results[name][indices] = value
+        return results[None] if outputs is None else results
+
+    def _pool_outputs(self, x, kinds, token_weights, grids, padded, gem_p):
+        """
+        对某一层的残差流 x (B, N, D) 做最后的 LayerNorm 并按 kinds 汇总，只对需要的 token 做归一化。
+        token_weights: 可选 (B, N) 每个 token 的权重（padding mask 或 token merging 的大小）
+        """
+        out = {}
+        if "cls" in kinds:
+            out["cls"] = self.norm(np.ascontiguousarray(x[:, 0]))
+        if not kinds & {"mean", "gem", "patch"}:
+            return out
+
+        patches = self.norm(x[:, 1:])  # (B, N-1, D)
+        w = None if token_weights is None else token_weights[:, 1:, None].astype(patches.dtype)
+        if "mean" in kinds:
+            out["mean"] = patches.mean(axis=1) if w is None else (patches * w).sum(axis=1) / w.sum(axis=1)
+        if "gem" in kinds:
+            powered = np.power(np.maximum(patches, 1e-6), gem_p)
+            pooled = powered.mean(axis=1) if w is None else (powered * w).sum(axis=1) / w.sum(axis=1)
+            out["gem"] = np.power(pooled, 1.0 / gem_p)
+        if "patch" in kinds:
+            B, _, D = patches.shape
+            if padded:
+                out["patch"] = [
+                    patches[i, :h * w_].reshape(h, w_, D).copy() for i, (h, w_) in enumerate(grids)
+                ]
+            else:
+                h, w_ = grids[0]
+                out["patch"] = patches.reshape(B, h, w_, D)
+        return out
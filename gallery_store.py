@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+# 图库文件：features.npy 第 i 行对应 images_map.json 第 i 条记录（清单）。
+# 每条记录：filename / path / size / mtime / sha1，删除的图片只打 "deleted": true 标记（tombstone），
+# 行号保持不变，增量构建只追加新行。
+# 构建过程中每批新记录追加写到 images_map.json.journal（checkpoint），中断后 load_manifest 会重放，
+# 重启的构建从最后一个完成的批次继续。
+FEATURE_FILE = "features.npy"
+MAP_FILE = "images_map.json"
+# 检索端使用的紧凑元数据表（由清单导出，可 mmap，按行号直接取路径，不必解析整个 JSON）
+TABLE_FILE = "images_map.bin"
+TABLE_MAGIC = b"GMAPv1\x00\x00"
+
+# 检索端可选的低精度特征（由 features.npy 导出）
+SEARCH_DTYPES = ("float16", "int8")
+
+# 新建 .npy 时为 header 预留的字节数，行数增长时原地改写 header，不必重写数据
+NPY_HEADER_SIZE = 256
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def journal_path(map_path):
+    return map_path + ".journal"
+
+
+def load_manifest(map_path):
+    """读取 images_map.json 并重放未合并的 journal（都不存在时返回空列表）"""
+    rows = []
+    if os.path.exists(map_path):
+        with open(map_path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+    if os.path.exists(journal_path(map_path)):
+        with open(journal_path(map_path), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # 中断时只写了一半的最后一行
+    return rows
+
+
+@contextmanager
+def atomic_write(path, mode="wb", **kwargs):
+    """
+    先写到同目录下唯一命名的临时文件，成功后 os.replace 到 path；出错时删除临时文件。
+    构建与 search_cli 可能同时重写同一文件（如元数据表），各自的临时文件互不干扰。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        # mkstemp 创建的文件权限为 0600，沿用原文件（或默认 0644）的权限
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_manifest(map_path, rows):
+    """先写临时文件再替换，中途中断不会留下半个清单；journal 已并入清单，随后删除"""
+    with atomic_write(map_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    if os.path.exists(journal_path(map_path)):
+        os.remove(journal_path(map_path))
+
+
+class ManifestJournal:
+    """
+    清单的追加写 checkpoint：每批记录写成一行一条 JSON 并落盘。
+    调用方须先把这批特征追加到 .npy 再写 journal，保证 journal 中的记录都有对应的特征行
+    （多出的特征行由下次构建截掉）。
+    """
+
+    def __init__(self, map_path, sync=True):
+        self.path = journal_path(map_path)
+        self.sync = sync
+        self.f = open(self.path, "a", encoding="utf-8")
+
+    def append(self, rows):
+        self.f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        self.f.flush()
+        if self.sync:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def live_rows(rows):
+    """未被 tombstone 的记录的行号（np.ndarray）"""
+    return np.array([i for i, row in enumerate(rows) if not row.get("deleted")], dtype=np.int64)
+
+
+def _npy_header(shape, dtype, size):
+    """size 字节的 1.0 版 .npy header；放不下时返回 None"""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": tuple(shape)})
+    # magic(6) + version(2) + header_len(2) + header，以空格补齐并以换行结尾
+    header_len = size - 10
+    if len(header) + 1 > header_len:
+        return None
+    return b"\x93NUMPY\x01\x00" + header_len.to_bytes(2, "little") + header.ljust(header_len - 1).encode("latin1") + b"\n"
+
+
+def _read_npy_header(f):
+    """返回 (shape, fortran_order, dtype, 数据起始偏移)；只有 1.0 版 header 可原地改写，其他版本偏移记为 None"""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        return shape, fortran_order, dtype, f.tell()
+    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, fortran_order, dtype, None
+
+
+def append_rows(path, rows, sync=False):
+    """
+    向 (N, D) 的 .npy 追加若干行：数据写到文件末尾，再原地改写 header 中的行数。
+    文件不存在时新建（header 预留 NPY_HEADER_SIZE 字节）；header 放不下时退回整体重写。
+    sync=True 时返回前落盘（写 checkpoint 之前调用）。
+    """
+    rows = np.ascontiguousarray(rows)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(_npy_header(rows.shape, rows.dtype, NPY_HEADER_SIZE))
+            f.write(rows.tobytes())
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        return rows.shape[0]
+
+    with open(path, "r+b") as f:
+        shape, fortran_order, dtype, offset = _read_npy_header(f)
+        if fortran_order or len(shape) != 2 or shape[1] != rows.shape[1] or dtype != rows.dtype:
+            raise ValueError(f"{path} 的形状/精度 {shape} {dtype} 与追加的 {rows.shape} {rows.dtype} 不一致")
+        new_shape = (shape[0] + rows.shape[0], shape[1])
+        header = None if offset is None else _npy_header(new_shape, dtype, offset)
+        if header is not None:
+            f.seek(offset + shape[0] * shape[1] * dtype.itemsize)
+            f.write(rows.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+            return new_shape[0]
+
+    features = np.concatenate([np.load(path), rows], axis=0)
+    save_rows(path, features)
+    return features.shape[0]
+
+
+def truncate_rows(path, num_rows):
+    """把 .npy 截断为前 num_rows 行（丢弃中断的构建追加、但清单未记录的行）"""
+    with open(path, "r+b") as f:
+        shape, _, dtype, offset = _read_npy_header(f)
+        if shape[0] <= num_rows:
+            return shape[0]
+        if offset is None:
+            f.close()
+            save_rows(path, np.load(path)[:num_rows])
+            return num_rows
+        f.seek(0)
+        f.write(_npy_header((num_rows, shape[1]), dtype, offset))
+        f.truncate(offset + num_rows * shape[1] * dtype.itemsize)
+        return num_rows
+
+
+def npy_shape(path):
+    with open(path, "rb") as f:
+        return _read_npy_header(f)[0]
+
+
+def save_rows(path, features):
+    """整体写出 (N, D) 特征（预留可追加的 header），先写临时文件再替换"""
+    with atomic_write(path) as f:
+        f.write(_npy_header(features.shape, features.dtype, NPY_HEADER_SIZE))
+        f.write(np.ascontiguousarray(features).tobytes())
+
+
+def search_feature_paths(feat_path, dtype):
+    """检索用低精度特征的路径：features.float16.npy，或 features.int8.npy + 每行缩放 features.int8.scale.npy"""
+    base = os.path.splitext(feat_path)[0]
+    return f"{base}.{dtype}.npy", (f"{base}.int8.scale.npy" if dtype == "int8" else None)
+
+
+def quantize_int8(rows):
+    """每行对称 int8 量化：rows ≈ q * scale[:, None]"""
+    scale = np.max(np.abs(rows), axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.round(rows / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def export_search_features(feat_path, dtype, chunk_rows=65536):
+    """
+    把 features.npy 导出为检索用的 float16 / int8 特征（可 mmap，体积为 float32 的 1/2、1/4）。
+    features.npy 只追加，因此只需逐块导出新增的行（全量重建、compact 后由 build_gallery 删除旧的导出）。
+    """
+    if dtype not in SEARCH_DTYPES:
+        raise ValueError(f"不支持的检索特征精度: {dtype}，可选: {SEARCH_DTYPES}")
+    out_path, scale_path = search_feature_paths(feat_path, dtype)
+    paths = [path for path in (out_path, scale_path) if path is not None]
+
+    num_rows = npy_shape(feat_path)[0]
+    done = min(npy_shape(path)[0] if os.path.exists(path) else 0 for path in paths)
+    if done > num_rows:
+        done = 0
+        for path in paths:
+            os.remove(path)
+    # 中断时 int8 与 scale 文件可能相差若干行，对齐到较短的一个
+    for path in paths:
+        if os.path.exists(path):
+            truncate_rows(path, done)
+
+    features = np.load(feat_path, mmap_mode="r")
+    for start in range(done, num_rows, chunk_rows):
+        chunk = np.asarray(features[start:start + chunk_rows], dtype=np.float32)
+        if dtype == "int8":
+            q, scale = quantize_int8(chunk)
+            append_rows(out_path, q)
+            append_rows(scale_path, scale[:, None])
+        else:
+            append_rows(out_path, chunk.astype(np.float16))
+    return out_path
+
+
+def save_metadata_table(path, rows):
+    """
+    把清单导出为列式元数据表：
+    magic(8) | 行数 N (uint64) | 路径偏移 offsets (int64, N+1) | deleted 标记 (uint8, N) | UTF-8 路径拼接
+    """
+    paths = [row["path"].encode("utf-8") for row in rows]
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in paths], out=offsets[1:])
+    deleted = np.array([bool(row.get("deleted")) for row in rows], dtype=np.uint8)
+    with atomic_write(path) as f:
+        f.write(TABLE_MAGIC)
+        f.write(np.uint64(len(paths)).tobytes())
+        f.write(offsets.tobytes())
+        f.write(deleted.tobytes())
+        f.write(b"".join(paths))
+
+
+class MetadataTable:
+    """只读 mmap 打开 save_metadata_table 写出的元数据表，打开与按行取路径都与行数无关"""
+
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:8]) != TABLE_MAGIC:
+            raise ValueError(f"{path} 不是图库元数据表")
+        n = int(self.data[8:16].view(np.uint64)[0])
+        start = 16
+        self.offsets = self.data[start:start + 8 * (n + 1)].view(np.int64)
+        start += 8 * (n + 1)
+        self.deleted = self.data[start:start + n]
+        self.blob_start = start + n
+        self.num_rows = n
+
+    def __len__(self):
+        return self.num_rows
+
+    def path(self, i):
+        start, end = self.blob_start + self.offsets[i], self.blob_start + self.offsets[i + 1]
+        return bytes(self.data[start:end]).decode("utf-8")
+
+    def filename(self, i):
+        return os.path.basename(self.path(i))
+
+    def live_rows(self):
+        return np.flatnonzero(self.deleted == 0)
@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FeaturePipeline:
+    """
+    批量特征提取的 解码/预处理 -> 推理 -> 写出 三段流水线。
+
+    - 解码/预处理：num_workers 个线程执行 load_fn(item) -> (pixel_values, meta)
+      （Pillow 解码与 NumPy 运算会释放 GIL，可与推理的 BLAS 并行）
+    - 推理：在调用 run 的线程中按 batch_size 组批，执行 infer_fn([pixel_values, ...]) -> (B, D)
+    - 写出：单独的写线程执行 write_fn(features, metas)
+
+    反压：最多 prefetch 张图像处于解码中或已解码待推理，写队列最多 write_queue_size 批，
+    任一下游阶段变慢时上游自动停下，内存占用有上界。结果按输入顺序写出。
+    """
+
+    def __init__(self, load_fn, infer_fn, write_fn, batch_size=16, num_workers=2, prefetch=None,
+                 write_queue_size=2, on_error=None):
+        self.load_fn = load_fn
+        self.infer_fn = infer_fn
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch or 2 * batch_size
+        self.write_queue_size = write_queue_size
+        self.on_error = on_error
+
+    def _timed_load(self, item):
+        start = time.perf_counter()
+        result = self.load_fn(item)
+        return result, time.perf_counter() - start
+
+    def run(self, items):
+        """
+        处理 items（任意可迭代对象，惰性读取），返回各阶段统计：
+        processed / failed 数量、总耗时、解码累计耗时、推理耗时、推理等待解码的时间、写出耗时
+        """
+        stats = {"processed": 0, "failed": 0, "decode_s": 0.0, "infer_s": 0.0, "wait_s": 0.0, "write_s": 0.0}
+        start = time.perf_counter()
+
+        write_queue = queue.Queue(maxsize=self.write_queue_size)
+        writer_errors = []
+
+        def writer():
+            while True:
+                batch = write_queue.get()
+                if batch is None:
+                    return
+                if writer_errors:
+                    continue  # 出错后只排空队列，避免推理线程阻塞
+                try:
+                    t = time.perf_counter()
+                    self.write_fn(*batch)
+                    stats["write_s"] += time.perf_counter() - t
+                except Exception as e:
+                    writer_errors.append(e)
+
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        writer_thread.start()
+
+        def flush(batch):
+            t = time.perf_counter()
+            features = self.infer_fn([pixel_values for pixel_values, _ in batch])
+            stats["infer_s"] += time.perf_counter() - t
+            write_queue.put((features, [meta for _, meta in batch]))
+            stats["processed"] += len(batch)
+
+        items = iter(items)
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=self.num_workers)
+
+        def fill():
+            while len(pending) < self.prefetch:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append((item, pool.submit(self._timed_load, item)))
+
+        try:
+            fill()
+            batch = []
+            while pending and not writer_errors:
+                item, future = pending.popleft()
+                fill()
+                t = time.perf_counter()
+                try:
+                    (pixel_values, meta), elapsed = future.result()
+                except Exception as e:
+                    stats["failed"] += 1
+                    if self.on_error is not None:
+                        self.on_error(item, e)
+                    continue
+                finally:
+                    stats["wait_s"] += time.perf_counter() - t
+                stats["decode_s"] += elapsed
+                batch.append((pixel_values, meta))
+                if len(batch) == self.batch_size:
+                    flush(batch)
+                    batch = []
+            if batch and not writer_errors:
+                flush(batch)
+        finally:
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            write_queue.put(None)
+            writer_thread.join()
+
+        if writer_errors:
+            raise writer_errors[0]
+        stats["elapsed_s"] = time.perf_counter() - start
+        return stats
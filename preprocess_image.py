@@ -1,37 +1,48 @@
+import io
+import os
+
+from functools import lru_cache
+
 import numpy as np
 from PIL import Image
 
-def center_crop(img_path, crop_size=224):
-    # 用于兜底或固定尺寸场景
-    image = Image.open(img_path).convert("RGB")
-    w, h = image.size
-    left = (w - crop_size) // 2
-    top = (h - crop_size) // 2
-    right = left + crop_size
-    bottom = top + crop_size
-    image = image.crop((left, top, right, bottom))
-    image = np.array(image).astype(np.float32) / 255.0
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    image = (image - mean) / std
-    image = image.transpose(2, 0, 1)
-    return image[None]
+try:
+    import cv2
+except ImportError:  # OpenCV 可选：未安装时 resize="cv2" / "auto" 回退到 Pillow
+    cv2 = None
 
-# ************* Finished: resize short side *************
-def resize_short_side(img_path, target_size=224, patch_size=14):
+# ImageNet 归一化参数；显式 float32，避免把输入张量悄悄提升为 float64
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+@lru_cache(maxsize=None)
+def normalization_lut(dtype=np.float32):
     """
-    1. 调整图像尺寸，使得短边长度为 target_size
-    2. 确保最终的高度和宽度都是 patch_size (14) 的整数倍
+    (3, 256) 的逐通道查找表：lut[c, v] = (v / 255 - mean[c]) / std[c]，按 dtype 计算，
+    与逐像素先转浮点再归一化的结果逐位一致。结果只读、按 dtype 缓存
     """
-    # Step 1: load image
-    try:
-        image = Image.open(img_path).convert("RGB")
-    except Exception as e:
-        raise ValueError(f"Cannot open image {img_path}: {e}")
-        
-    w, h = image.size
+    dtype = np.dtype(dtype)
+    values = np.arange(256, dtype=dtype) / 255.0
+    lut = (values[None, :] - IMAGENET_MEAN.astype(dtype)[:, None]) / IMAGENET_STD.astype(dtype)[:, None]
+    lut.flags.writeable = False
+    return lut
 
-    # Step 2: compute new size
+def normalize_to_chw(pixels, dtype=np.float32, out=None):
+    """
+    (H, W, 3) uint8 -> 归一化后的 (3, H, W)：每个通道查 normalization_lut，
+    直接写入 out（如 batch 缓冲区中的一个槽位），不产生整幅的浮点临时数组
+    """
+    lut = normalization_lut(np.dtype(dtype))
+    H, W, _ = pixels.shape
+    if out is None:
+        out = np.empty((3, H, W), dtype=dtype)
+    out = out.reshape(3, H, W)
+    for c in range(3):
+        np.take(lut[c], pixels[:, :, c], out=out[c])
+    return out
+
+def short_side_size(w, h, target_size=224, patch_size=14):
+    """resize_short_side 的输出尺寸 (new_w, new_h)：短边缩放到 target_size，长宽取 patch_size 的整数倍"""
     # 找到短边，计算缩放比例
     if w < h:
         scale = target_size / w
@@ -42,26 +53,97 @@ def resize_short_side(img_path, target_size=224, patch_size=14):
         new_h = target_size
         new_w = int(round(w * scale))
 
-    # Step 3: Snap to multiples of patch_size
     # 确保长宽都是 14 的倍数
     new_w = int(round(new_w / patch_size)) * patch_size
     new_h = int(round(new_h / patch_size)) * patch_size
-    
+
     # 防止极少数情况尺寸归零
-    new_w = max(new_w, patch_size)
-    new_h = max(new_h, patch_size)
+    return max(new_w, patch_size), max(new_h, patch_size)
+
+def open_image(image_input):
+    """
+    把各种输入统一为 PIL Image（只读文件头，尚未解码），不经过临时文件：
+      - 文件路径（str / os.PathLike）
+      - bytes / bytearray / memoryview（编码后的图像数据）
+      - 文件对象（有 read 方法，如上传文件、BytesIO）
+      - np.ndarray：(H, W, 3) 或 (H, W) 的 uint8 像素
+      - PIL Image
+    """
+    if isinstance(image_input, Image.Image):
+        return image_input
+    if isinstance(image_input, np.ndarray):
+        return Image.fromarray(image_input)
+    if isinstance(image_input, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(image_input))
+    if isinstance(image_input, (str, os.PathLike)) or hasattr(image_input, "read"):
+        return Image.open(image_input)
+    raise ValueError(f"不支持的图像输入类型: {type(image_input)}")
 
-    # 使用 Bicubic 插值以获得更好质量
-    image = image.resize((new_w, new_h), resample=Image.BICUBIC)
+def load_image(image_input, draft_size=None):
+    """
+    open_image 并解码为 RGB。
+    draft_size: 可选 (w, h)。对 JPEG 调用 Image.draft 让 libjpeg 在 DCT 域按 1/2、1/4、1/8 缩放解码，
+                解码结果不小于 draft_size，大图无需先按原分辨率解码。对其他格式无影响；
+                draft 会原地修改图像，因此调用方传入的 PIL Image 不做 draft
+    """
+    image = open_image(image_input)
+    if (draft_size is not None and not isinstance(image_input, Image.Image)
+            and getattr(image, "format", None) == "JPEG"):
+        image.draft("RGB", draft_size)
+    return image.convert("RGB")
 
-    # Step 4: to_numpy & normalize
-    image = np.array(image).astype(np.float32) / 255.0  # (H, W, C)
+def center_crop(img_path, crop_size=224, dtype=np.float32):
+    # 用于兜底或固定尺寸场景；img_path 可以是 load_image 支持的任意输入
+    image = load_image(img_path)
+    w, h = image.size
+    left = (w - crop_size) // 2
+    top = (h - crop_size) // 2
+    right = left + crop_size
+    bottom = top + crop_size
+    image = image.crop((left, top, right, bottom))
+    return normalize_to_chw(np.asarray(image), dtype)[None]
+
+# ************* Finished: resize short side *************
+def resize_short_side(img_path, target_size=224, patch_size=14, dtype=np.float32, draft=True, out=None,
+                      resize="pil"):
+    """
+    1. 调整图像尺寸，使得短边长度为 target_size
+    2. 确保最终的高度和宽度都是 patch_size (14) 的整数倍
+    3. 输出张量的精度由 dtype 决定（默认 float32）
+
+    img_path 可以是 load_image 支持的任意输入（路径、bytes、文件对象、ndarray、PIL Image）。
+    draft: 为 True 时 JPEG 以接近目标尺寸的 DCT 缩放解码（见 load_image），再做 bicubic resize；
+           输出尺寸只由原图尺寸决定，与是否 draft 无关。传入 PIL Image 时不做 draft，不修改调用方的图像
+    out: 可选的 (C, H, W) 或 (1, C, H, W) 输出缓冲区（可以是 batch 缓冲区中的槽位），
+         尺寸可用 short_side_size 预先算出；归一化结果经查找表直接写入
+    resize: "pil"（Pillow bicubic，与图库特征一致）/ "cv2"（OpenCV，缩小用 INTER_AREA、放大用 INTER_CUBIC，
+            通常更快但像素与 Pillow 略有差异）/ "auto"（安装了 OpenCV 时用 cv2）
+    """
+    # Step 1: load image（只读文件头，得到原图尺寸）
+    try:
+        image = open_image(img_path)
+    except Exception as e:
+        raise ValueError(f"Cannot open image {img_path if isinstance(img_path, (str, os.PathLike)) else type(img_path)}: {e}")
+
+    # Step 2 / 3: compute new size，长宽都是 patch_size 的整数倍
+    w, h = image.size
+    new_w, new_h = short_side_size(w, h, target_size, patch_size)
+
+    # 解码（JPEG 可按 DCT 缩放到不小于目标尺寸），再 resize
+    draft = draft and not isinstance(img_path, Image.Image)
+    image = load_image(image, draft_size=(new_w, new_h) if draft else None)
+    if resize == "cv2" or (resize == "auto" and cv2 is not None):
+        if cv2 is None:
+            raise ImportError("resize='cv2' 需要安装 opencv-python")
+        pixels = np.asarray(image)
+        interpolation = cv2.INTER_AREA if new_w < pixels.shape[1] else cv2.INTER_CUBIC
+        pixels = cv2.resize(pixels, (new_w, new_h), interpolation=interpolation)
+    else:
+        # 使用 Bicubic 插值以获得更好质量
+        pixels = np.asarray(image.resize((new_w, new_h), resample=Image.BICUBIC))
+
+    # Step 4: uint8 经查找表归一化，直接写成 (C, H, W)
+    image = normalize_to_chw(pixels, dtype, out=out)
 
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    image = (image - mean) / std  # (H, W, C)
-    
-    image = image.transpose(2, 0, 1)  # (C, H, W)
-    
     # 返回 (1, C, H, W) 用于直接推理
-    return image[None]
\ No newline at end of file
+    return image[None]
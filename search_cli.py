@@ -1,87 +1,306 @@
 import os
+import csv
 import json
+import time
+import argparse
+import threading
 import numpy as np
-import sys
 
-from dinov2_numpy import Dinov2Numpy
+from dinov2_numpy import Dinov2Numpy, load_weights, mmap_weights_path
 # ⚠️ 修正：改为使用 resize_short_side，与图库构建保持一致
 from preprocess_image import resize_short_side 
+from pipeline import FeaturePipeline
+from gallery_store import (
+    FEATURE_FILE,
+    MAP_FILE,
+    SEARCH_DTYPES,
+    TABLE_FILE,
+    MetadataTable,
+    export_search_features,
+    journal_path,
+    load_manifest,
+    save_metadata_table,
+    search_feature_paths,
+)
 
 # ================= 配置 =================
 GALLERY_DIR = "gallery"
-FEATURE_FILE = "features.npy"
-MAP_FILE = "images_map.json"
 MODEL_WEIGHTS = "vit-dinov2-base.npz"
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg', '.webp')
+BLOCK_ROWS = 16384  # 分块打分时每块的图库行数
 # =======================================
 
-def load_metadata(map_path):
-    if not os.path.exists(map_path):
+def load_metadata(gallery_dir):
+    """
+    mmap 打开 build_gallery 导出的元数据表，只在取 top-k 结果时按行号读取文件名，不加载整个清单。
+    元数据表缺失（旧版图库、全量重建中）或比清单 / journal 旧（构建进行中）时，先从清单重新导出。
+    """
+    table_path = os.path.join(gallery_dir, TABLE_FILE)
+    map_path = os.path.join(gallery_dir, MAP_FILE)
+    sources = [path for path in (map_path, journal_path(map_path)) if os.path.exists(path)]
+    if not sources and not os.path.exists(table_path):
         raise FileNotFoundError(f"找不到索引文件: {map_path}")
-    
-    with open(map_path, "r", encoding="utf-8") as f:
-        # build_gallery 现在保存的是标准 JSON List，直接 load
-        return json.load(f)
+    if sources and (
+        not os.path.exists(table_path)
+        or max(os.path.getmtime(path) for path in sources) > os.path.getmtime(table_path)
+    ):
+        save_metadata_table(table_path, load_manifest(map_path))
+    return MetadataTable(table_path)
 
-def search_image(query_path, k=10):
-    # 1. 检查文件
-    feat_path = os.path.join(GALLERY_DIR, FEATURE_FILE)
-    map_path = os.path.join(GALLERY_DIR, MAP_FILE)
+def blocked_top_k(query_feats, gallery_feats, k, num_rows=None, scale=None, deleted=None, block_rows=BLOCK_ROWS):
+    """
+    分块打分 + 部分排序的 top-k：
+    每次只把 block_rows 行图库特征（float32 / float16 / int8，可为 mmap）转成 float32 做矩阵乘法，
+    块内用 argpartition 取前 k，与当前的 top-k 合并后再 argpartition，最后只对 k 个结果排序，
+    总开销 O(N) 而非全量 argsort 的 O(N log N)。
 
-    if not os.path.exists(feat_path) or not os.path.exists(map_path):
-        print("❌ 错误：图库未构建，请先运行 build_gallery.py")
-        return
+    scale: int8 特征的每行缩放；deleted: 每行的 tombstone 标记（非 0 的行不参与）
+    返回 (scores, rows)，形状均为 (B, k)，按分数从大到小排列；有效行数不足 k 时以 -inf 补位
+    """
+    query_feats = np.asarray(query_feats, dtype=np.float32)
+    num_queries = query_feats.shape[0]
+    num_rows = gallery_feats.shape[0] if num_rows is None else num_rows
+    top_scores = np.full((num_queries, 0), -np.inf, dtype=np.float32)
+    top_rows = np.zeros((num_queries, 0), dtype=np.int64)
 
-    # 2. 加载图库
-    print(f"[INFO] Loading gallery...")
-    gallery_feats = np.load(feat_path).astype(np.float32) # (N, 768)
-    meta = load_metadata(map_path)
+    for start in range(0, num_rows, block_rows):
+        end = min(start + block_rows, num_rows)
+        block = np.asarray(gallery_feats[start:end], dtype=np.float32)
+        # 计算相似度 (矩阵乘法)：query (B, 768), block (b, 768) -> (B, b)
+        scores = query_feats @ block.T
+        if scale is not None:
+            scores *= np.asarray(scale[start:end], dtype=np.float32)
+        if deleted is not None:
+            # 增量构建中已删除的图片只打了 tombstone 标记，检索时跳过这些行
+            scores[:, np.asarray(deleted[start:end]) != 0] = -np.inf
 
-    # 3. 加载模型
-    print(f"[INFO] Loading model...")
-    if not os.path.exists(MODEL_WEIGHTS):
-        print(f"❌ 权重文件 {MODEL_WEIGHTS} 缺失")
-        return
-    weights = np.load(MODEL_WEIGHTS)
-    model = Dinov2Numpy(weights)
+        if scores.shape[1] > k:
+            idx = np.argpartition(scores, -k, axis=1)[:, -k:]
+            scores = np.take_along_axis(scores, idx, axis=1)
+        else:
+            idx = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        top_scores = np.concatenate([top_scores, scores], axis=1)
+        top_rows = np.concatenate([top_rows, idx + start], axis=1)
+        if top_scores.shape[1] > k:
+            idx = np.argpartition(top_scores, -k, axis=1)[:, -k:]
+            top_scores = np.take_along_axis(top_scores, idx, axis=1)
+            top_rows = np.take_along_axis(top_rows, idx, axis=1)
 
-    # 4. 处理查询图片
-    print(f"[INFO] Processing query: {query_path}")
-    try:
+    # 排序 (从大到小)，只排 k 个
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_rows, order, axis=1)
+
+class SearchSession:
+    """
+    常驻内存的模型与图库：交互模式与批量模式下只加载一次权重、模型与图库，
+    之后每次检索只需预处理 + 前向 + 分块打分。
+
+    图库特征只读 mmap 打开，dtype 可选 float32（features.npy）或 build_gallery --search-dtype
+    导出的 float16 / int8，按 block_rows 行分块计算相似度，内存占用与图库大小无关。
+    """
+
+    def __init__(self, gallery_dir=GALLERY_DIR, weights_path=MODEL_WEIGHTS, target_size=224, patch_size=14,
+                 dtype="float32", block_rows=BLOCK_ROWS):
+        feat_path = os.path.join(gallery_dir, FEATURE_FILE)
+        map_path = os.path.join(gallery_dir, MAP_FILE)
+        table_path = os.path.join(gallery_dir, TABLE_FILE)
+        if not os.path.exists(feat_path) or not any(
+            os.path.exists(path) for path in (map_path, journal_path(map_path), table_path)
+        ):
+            raise FileNotFoundError("图库未构建，请先运行 build_gallery.py")
+        if not os.path.exists(weights_path) and not os.path.exists(mmap_weights_path(weights_path)):
+            raise FileNotFoundError(f"权重文件 {weights_path} 缺失")
+
+        # 1. 加载图库
+        print(f"[INFO] Loading gallery...")
+        self.meta = load_metadata(gallery_dir)
+        self.scale = None
+        if dtype == "float32":
+            self.gallery_feats = np.load(feat_path, mmap_mode="r")  # (N, 768)
+        else:
+            # 首次使用时导出，之后只补齐 features.npy 新增的行
+            search_path = export_search_features(feat_path, dtype)
+            _, scale_path = search_feature_paths(feat_path, dtype)
+            self.gallery_feats = np.load(search_path, mmap_mode="r")
+            if scale_path is not None:
+                self.scale = np.load(scale_path, mmap_mode="r")[:, 0]
+        # 构建进行中时特征可能多于元数据表，只检索两者都有的行
+        self.num_rows = min(self.gallery_feats.shape[0], len(self.meta))
+        self.block_rows = block_rows
+
+        # 2. 加载模型
+        print(f"[INFO] Loading model...")
+        # 若已用 convert_weights.py 生成 .mmap 权重文件，则直接 mmap 加载
+        self.model = Dinov2Numpy(load_weights(weights_path))
+        self.target_size = target_size
+        self.patch_size = patch_size
+
+    def preprocess(self, query_path):
         # ✅ 关键：使用同样的预处理策略 (Resize Short Side)
-        query_input = resize_short_side(query_path, target_size=224, patch_size=14)
-    except Exception as e:
-        print(f"❌ 图片处理失败: {e}")
-        return
+        return resize_short_side(query_path, target_size=self.target_size, patch_size=self.patch_size)
 
-    # 5. 提取特征
-    # 输出 (1, 768)
-    query_feat = model(query_input).astype(np.float32)
-    
-    # 6. 归一化 (Cosine Similarity 前置步骤)
-    query_norm = np.linalg.norm(query_feat, axis=1, keepdims=True)
-    query_feat = query_feat / (query_norm + 1e-6)
+    def embed(self, query_inputs):
+        """预处理后的查询（单个 (1, C, H, W) 或分辨率各异的 list）-> L2 归一化的 (B, 768)"""
+        query_feat = self.model(query_inputs).astype(np.float32)
+        # 归一化 (Cosine Similarity 前置步骤)
+        query_norm = np.linalg.norm(query_feat, axis=1, keepdims=True)
+        return query_feat / (query_norm + 1e-6)
 
-    # 7. 计算相似度 (矩阵乘法)
-    # query: (1, 768), gallery: (N, 768) -> (1, N)
-    scores = np.dot(query_feat, gallery_feats.T).flatten()
+    def search_features(self, query_feats, k=10):
+        """(B, 768) 查询特征 -> 每个查询的 [{rank, score, filename, path}, ...]"""
+        top_scores, top_rows = blocked_top_k(
+            query_feats, self.gallery_feats, k, num_rows=self.num_rows, scale=self.scale,
+            deleted=self.meta.deleted, block_rows=self.block_rows
+        )
+        results = []
+        for query_scores, rows in zip(top_scores, top_rows):
+            results.append([
+                {
+                    "rank": rank,
+                    "score": float(score),
+                    "filename": self.meta.filename(row),
+                    "path": self.meta.path(row),
+                }
+                # 图库有效行数不足 k 时，补位的 -inf 不输出
+                for rank, (score, row) in enumerate(zip(query_scores, rows), start=1) if np.isfinite(score)
+            ])
+        return results
 
-    # 8. 排序 (从大到小)
-    top_indices = np.argsort(scores)[::-1][:k]
+    def search(self, query_path, k=10):
+        return self.search_features(self.embed(self.preprocess(query_path)), k)[0]
 
-    # 9. 打印结果
+
+def print_results(query_path, results):
     print("\n" + "="*50)
     print(f"🔍 Search Results for: {os.path.basename(query_path)}")
     print("="*50)
     
-    for rank, idx in enumerate(top_indices, start=1):
-        score = scores[idx]
-        item = meta[idx]
-        print(f"Rank {rank:02d} | Similarity: {score:.4f} | {item['filename']}")
+    for item in results:
+        print(f"Rank {item['rank']:02d} | Similarity: {item['score']:.4f} | {item['filename']}")
         # print(f"        Path: {item['path']}") # 可选打印完整路径
         print("-" * 50)
 
+def open_session(gallery_dir=GALLERY_DIR, dtype="float32"):
+    try:
+        return SearchSession(gallery_dir, dtype=dtype)
+    except FileNotFoundError as e:
+        print(f"❌ 错误：{e}")
+        return None
+
+def search_image(query_path, k=10, dtype="float32"):
+    session = open_session(dtype=dtype)
+    if session is None:
+        return
+
+    print(f"[INFO] Processing query: {query_path}")
+    try:
+        results = session.search(query_path, k)
+    except Exception as e:
+        print(f"❌ 图片处理失败: {e}")
+        return
+    print_results(query_path, results)
+
+def interactive(k=10, dtype="float32"):
+    """交互模式：模型与图库常驻，每行输入一个查询图片路径，输入 quit 或 Ctrl-D 退出"""
+    session = open_session(dtype=dtype)
+    if session is None:
+        return
+    print("[INFO] Ready. Enter a query image path (quit to exit).")
+    while True:
+        try:
+            line = input("query> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if line in ("quit", "exit"):
+            break
+        if not line:
+            continue
+        query_path = line.strip("'\"")
+        start = time.perf_counter()
+        try:
+            results = session.search(query_path, k)
+        except Exception as e:
+            print(f"❌ 图片处理失败: {e}")
+            continue
+        print_results(query_path, results)
+        print(f"[INFO] {(time.perf_counter() - start) * 1000:.1f} ms")
+
+def list_queries(source):
+    """查询来源：图片目录，或每行一个图片路径的文本文件"""
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, f) for f in os.listdir(source) if f.lower().endswith(IMAGE_EXTS)
+        )
+    with open(source, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def batch_search(source, out_path, k=10, batch_size=16, num_workers=2, dtype="float32"):
+    """
+    批量模式：对目录或列表文件中的全部查询分批提取特征并检索，结果写入 out_path。
+    .csv 每行一个 (query, rank, score, filename, path)，其他后缀写 JSONL（每个查询一行）。
+    """
+    queries = list_queries(source)
+    session = open_session(dtype=dtype)
+    if session is None:
+        return
+    print(f"[INFO] {len(queries)} queries -> {out_path}")
+
+    as_csv = out_path.lower().endswith(".csv")
+    with open(out_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if as_csv else None
+        if as_csv:
+            writer.writerow(["query", "rank", "score", "filename", "path"])
+
+        def load(query_path):
+            return session.preprocess(query_path), query_path
+
+        # write 在流水线写线程、skip 在推理线程中调用，写文件需加锁
+        lock = threading.Lock()
+
+        def write(query_feats, query_paths):
+            results_list = session.search_features(query_feats, k)
+            with lock:
+                for query_path, results in zip(query_paths, results_list):
+                    if as_csv:
+                        writer.writerows(
+                            [query_path, r["rank"], f"{r['score']:.6f}", r["filename"], r["path"]] for r in results
+                        )
+                    else:
+                        f.write(json.dumps({"query": query_path, "results": results}, ensure_ascii=False) + "\n")
+
+        def skip(query_path, e):
+            print(f"Skipping {query_path}: {e}")
+            if not as_csv:
+                with lock:
+                    f.write(json.dumps({"query": query_path, "error": str(e)}, ensure_ascii=False) + "\n")
+
+        # 解码/预处理与推理重叠，分辨率各异的查询以 list 形式走 padded batch
+        pipeline = FeaturePipeline(load, session.embed, write, batch_size=batch_size, num_workers=num_workers,
+                                   on_error=skip)
+        stats = pipeline.run(queries)
+    print(
+        f"✅ Done! {stats['processed']} queries searched, {stats['failed']} failed, "
+        f"total {stats['elapsed_s']:.1f}s ({stats['elapsed_s'] * 1000 / max(len(queries), 1):.1f} ms/query)"
+    )
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python search_cli.py <path_to_query_image>")
+    parser = argparse.ArgumentParser(description="Search the image gallery")
+    parser.add_argument("query", nargs="?", help="查询图片路径")
+    parser.add_argument("-k", type=int, default=10, help="返回结果数")
+    parser.add_argument("-i", "--interactive", action="store_true", help="交互模式，模型与图库常驻")
+    parser.add_argument("--batch", default=None, help="批量查询：图片目录或每行一个路径的文本文件")
+    parser.add_argument("--out", default="results.jsonl", help="批量结果输出（.jsonl 或 .csv）")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="解码/预处理线程数")
+    parser.add_argument("--dtype", choices=("float32",) + SEARCH_DTYPES, default="float32",
+                        help="图库特征精度（float16 / int8 需 build_gallery --search-dtype 导出，缺失时自动导出）")
+    args = parser.parse_args()
+    if args.interactive:
+        interactive(args.k, args.dtype)
+    elif args.batch:
+        batch_search(args.batch, args.out, args.k, args.batch_size, args.workers, args.dtype)
+    elif args.query:
+        search_image(args.query, args.k, args.dtype)
     else:
-        search_image(sys.argv[1])
\ No newline at end of file
+        parser.print_usage()